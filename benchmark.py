@@ -0,0 +1,916 @@
+import json
+import math
+import pickle
+import random
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import skia
+from browser import *
+
+STAGES = [
+    "parse", "style", "layout", "accessibility", "paint",
+    "composite", "raster",
+]
+
+LOAD_TIMEOUT_SEC = 300
+SCRIPT_MAX_AGE_SEC = 3600
+
+CORPUS = {
+    "small": {
+        "nodes": 100, "depth": 4, "rules": 10,
+        "scripts": 1, "text": 20,
+    },
+    "medium": {
+        "nodes": 1000, "depth": 8, "rules": 50,
+        "scripts": 4, "text": 40,
+    },
+    "large": {
+        "nodes": 5000, "depth": 16, "rules": 200,
+        "scripts": 8, "text": 80,
+    },
+}
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "browser",
+         "engineering", "layout", "paint", "raster"]
+TAGS = ["div", "p", "section", "article", "span", "b", "i"]
+COLORS = list(NAMED_COLORS)
+
+def make_text(length):
+    return " ".join(random.choice(WORDS) for _ in range(length))
+
+def make_page(name, nodes, depth, rules, scripts, text):
+    random.seed(name)
+    out = "<!doctype html>"
+    out += "<link rel=stylesheet href=/{}.css>".format(name)
+    open_tags = []
+    for i in range(nodes):
+        if len(open_tags) >= depth or \
+           (open_tags and random.random() < 0.4):
+            out += "</" + open_tags.pop() + ">"
+        tag = random.choice(TAGS)
+        out += "<" + tag + ">"
+        out += make_text(random.randint(1, text))
+        open_tags.append(tag)
+    while open_tags:
+        out += "</" + open_tags.pop() + ">"
+    for i in range(scripts):
+        out += "<script src=/{}/{}.js></script>".format(name, i)
+    return out
+
+def make_stylesheet(name, rules):
+    random.seed(name)
+    out = ""
+    for i in range(rules):
+        selector = " ".join(
+            random.choice(TAGS) for _ in range(random.randint(1, 3)))
+        out += "{} {{ color: {}; }}\n".format(
+            selector, random.choice(COLORS))
+    return out
+
+def make_script(name, i):
+    return "var nodes = document.querySelectorAll(\"{}\");\n".format(
+        TAGS[i % len(TAGS)])
+
+class FixtureServer:
+    def __init__(self, corpus, pages=None):
+        self.corpus = corpus
+        self.pages = pages or {}
+        self.requested = []
+        self.socket = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("localhost", 0))
+        self.port = self.socket.getsockname()[1]
+        self.socket.listen()
+        self.thread = threading.Thread(
+            target=self.serve, name="Fixture server", daemon=True)
+        self.thread.start()
+
+    def url(self, name):
+        return URL("http://localhost:{}/{}".format(self.port, name))
+
+    def serve(self):
+        while True:
+            conx, addr = self.socket.accept()
+            self.handle_connection(conx)
+
+    def handle_connection(self, conx):
+        req = conx.makefile("b")
+        reqline = req.readline().decode("utf8")
+        method, url, version = reqline.split(" ", 2)
+        while True:
+            line = req.readline().decode("utf8")
+            if line == "\r\n": break
+
+        status, body = self.do_request(method, url)
+        response = "HTTP/1.0 {}\r\n".format(status)
+        response += "Content-Length: {}\r\n".format(
+            len(body.encode("utf8")))
+        if url.endswith(".js"):
+            response += "Cache-Control: max-age={}\r\n".format(
+                SCRIPT_MAX_AGE_SEC)
+        response += "\r\n" + body
+        conx.send(response.encode("utf8"))
+        conx.close()
+
+    def do_request(self, method, url):
+        path = urllib.parse.unquote(url)[1:]
+        self.requested.append(path)
+        if path in self.pages:
+            return "200 OK", self.pages[path]
+        elif path.endswith(".css") and path[:-4] in self.corpus:
+            name = path[:-4]
+            return "200 OK", make_stylesheet(
+                name, self.corpus[name]["rules"])
+        elif path.endswith(".js") and "/" in path:
+            name, script = path.split("/", 1)
+            return "200 OK", make_script(name, int(script[:-3]))
+        elif path in self.corpus:
+            return "200 OK", make_page(path, **self.corpus[path])
+        else:
+            return "404 Not Found", "<h1>{} not found</h1>".format(url)
+
+def summarize(times):
+    times = sorted(times)
+    if not times:
+        return {"p50": None, "p95": None, "count": 0}
+    return {
+        "p50": times[len(times) // 2] * 1000,
+        "p95": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        "count": len(times),
+    }
+
+def report(name, times):
+    summary = summarize(times)
+    print("{}: p50={:.2f}ms p95={:.2f}ms mean={:.2f}ms".format(
+        name, summary["p50"], summary["p95"],
+        statistics.mean(times) * 1000))
+
+FAILURES = []
+
+def check(name, ok):
+    print("  {}: {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        FAILURES.append(name)
+    return ok
+
+def headless_browser(**kwargs):
+    browser = Browser(headless=True, **kwargs)
+    browser.measure.collect_durations()
+    return browser
+
+def wait_for_load(browser, name):
+    if run_headless(browser, LOAD_TIMEOUT_SEC): return True
+    print("Timed out loading", name)
+    FAILURES.append("load " + name)
+    return False
+
+def open_page(server, name, **kwargs):
+    browser = headless_browser(**kwargs)
+    browser.new_tab(server.url(name))
+    wait_for_load(browser, name)
+    return browser
+
+def navigate(browser, url):
+    browser.lock.acquire(blocking=True)
+    browser.schedule_load(url)
+    browser.lock.release()
+
+def force_full_raster(browser):
+    browser.lock.acquire(blocking=True)
+    browser.damage = None
+    browser.draw_damage = None
+    browser.set_needs_composite()
+    browser.lock.release()
+    browser.composite_raster_and_draw()
+
+def matches_full_raster(browser):
+    before = browser.root_surface.makeImageSnapshot().tobytes()
+    force_full_raster(browser)
+    after = browser.root_surface.makeImageSnapshot().tobytes()
+    return before == after
+
+def benchmark_pages(corpus=CORPUS, runs=5):
+    server = FixtureServer(corpus)
+    browser = headless_browser()
+    results = {}
+    for name in corpus:
+        durations = {stage: [] for stage in STAGES + ["load"]}
+        for i in range(runs):
+            url = server.url(name)
+            start = time.perf_counter()
+            if not browser.tabs:
+                browser.new_tab(url)
+            else:
+                navigate(browser, url)
+            if not wait_for_load(browser, name):
+                continue
+            durations["load"].append(time.perf_counter() - start)
+            for stage, times in browser.measure.take_durations().items():
+                if stage in durations:
+                    durations[stage].extend(times)
+        results[name] = {
+            stage: summarize(times)
+            for stage, times in durations.items()
+        }
+        print(name)
+        for stage, summary in results[name].items():
+            if not summary["count"]: continue
+            print("  {}: p50={:.2f}ms p95={:.2f}ms".format(
+                stage, summary["p50"], summary["p95"]))
+    print("script cache", browser.script_cache.stats())
+    browser.handle_quit()
+    return results
+
+def make_composite_display_list(num_commands, num_effects):
+    random.seed(0)
+    display_list = []
+    effects = []
+    for i in range(num_effects):
+        node = Element("div", {}, None)
+        node.style = {"opacity": "0.5"}
+        effects.append(Blend(0.5, None, node, []))
+    for i in range(num_commands):
+        rect = skia.Rect.MakeXYWH(
+            random.randint(0, WIDTH - 100),
+            i * 20, random.randint(10, 100), 18)
+        cmd = DrawRRect(rect, 0, "lightblue")
+        if random.random() < 0.2:
+            effect = random.choice(effects)
+            effect.children.append(cmd)
+            effect.rect.join(rect)
+        else:
+            display_list.append(cmd)
+    for effect in effects:
+        display_list.insert(
+            random.randint(0, len(display_list)), effect)
+    return display_list
+
+def scan_composited_layers(display_list, tile_cache):
+    # The reverse scan assign_composited_layers replaced, kept so the
+    # benchmark measures the overlap index against it.
+    layers = []
+    add_parent_pointers(display_list)
+    all_commands = []
+    for cmd in display_list:
+        all_commands = tree_to_list(cmd, all_commands)
+    non_composited_commands = [cmd
+        for cmd in all_commands
+        if isinstance(cmd, PaintCommand) or \
+            not cmd.needs_compositing
+        if not cmd.parent or cmd.parent.needs_compositing
+    ]
+    for cmd in non_composited_commands:
+        rect = local_to_absolute(cmd, cmd.rect)
+        for layer in reversed(layers):
+            if layer.can_merge(cmd):
+                layer.add(cmd, rect)
+                break
+            elif skia.Rect.Intersects(layer.absolute_bounds(), rect):
+                layers.append(CompositedLayer(tile_cache, cmd, rect))
+                break
+        else:
+            layers.append(CompositedLayer(tile_cache, cmd, rect))
+    return layers
+
+def layer_items(layers):
+    return [[id(item) for item in layer.display_items]
+            for layer in layers]
+
+def benchmark_composite(
+    cases=[(500, 40), (2000, 40), (5000, 40), (5000, 2500)], runs=10):
+    results = {}
+    for (num_commands, num_effects) in cases:
+        display_list = make_composite_display_list(
+            num_commands, num_effects)
+        name = "{}x{}".format(num_commands, num_effects)
+        results[name] = {}
+        layers = {}
+        for algorithm, assign in [
+            ("scan", scan_composited_layers),
+            ("indexed", assign_composited_layers)]:
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                layers[algorithm] = assign(
+                    display_list, TileCache(SurfacePool(None)))
+                times.append(time.perf_counter() - start)
+            results[name][algorithm] = summarize(times)
+            report("{} commands, {} effects, {}".format(
+                num_commands, num_effects, algorithm), times)
+        print("  {} layers".format(len(layers["indexed"])))
+        check("same layers as scan", layer_items(layers["scan"]) ==
+            layer_items(layers["indexed"]))
+    return results
+
+def benchmark_timers(num_timers=10000, max_delay_ms=100):
+    random.seed(0)
+    task_runner = TaskRunner(None)
+    timers = TimerService(task_runner)
+    task_runner.start_thread()
+    timers.start_thread()
+
+    fired = []
+    done = threading.Event()
+    def callback(scheduled):
+        fired.append(time.perf_counter() - scheduled)
+        if len(fired) == num_timers:
+            done.set()
+
+    threads_before = threading.active_count()
+    peak_threads = threads_before
+    start = time.perf_counter()
+    for i in range(num_timers):
+        delay = random.randint(0, max_delay_ms) / 1000
+        timers.set_timer(delay, callback, time.perf_counter() + delay)
+        peak_threads = max(peak_threads, threading.active_count())
+    schedule_time = time.perf_counter() - start
+    done.wait()
+    total_time = time.perf_counter() - start
+
+    timers.set_needs_quit()
+    task_runner.set_needs_quit()
+    print("{} timers: scheduled in {:.2f}ms, all fired after {:.2f}ms, "
+          "{} extra threads".format(
+          num_timers, schedule_time * 1000, total_time * 1000,
+          peak_threads - threads_before))
+    report("timer lateness", fired)
+    return {"lateness": summarize(fired)}
+
+SOAK_JS = """
+var timers_left = {timers};
+var xhrs_left = {xhrs};
+var done = 0;
+var target = {timers} + {xhrs};
+var box = document.querySelectorAll("div")[0];
+
+function on_timer() {{
+  done++;
+}}
+
+function timer_batch() {{
+  var n = Math.min(1000, timers_left);
+  for (var i = 0; i < n; i++) setTimeout(on_timer, 0);
+  timers_left -= n;
+  box.innerHTML = "<span>batch</span>";
+  document.querySelectorAll("span")[0].addEventListener("click", on_timer);
+  if (timers_left > 0) setTimeout(timer_batch, 1);
+}}
+
+function send_xhr() {{
+  if (xhrs_left <= 0) return;
+  xhrs_left--;
+  var xhr = new XMLHttpRequest();
+  xhr.open("GET", "/xhr", true);
+  xhr.onload = function () {{
+    done++;
+    send_xhr();
+  }};
+  xhr.send(null);
+}}
+
+timer_batch();
+for (var i = 0; i < {concurrency}; i++) send_xhr();
+"""
+
+SOAK_STATS_JS = "[typeof done == 'undefined' ? -1 : done, " + \
+    "typeof target == 'undefined' ? 0 : target, " + \
+    "Object.keys(SET_TIMEOUT_REQUESTS).length, " + \
+    "Object.keys(XHR_REQUESTS).length, Object.keys(LISTENERS).length]"
+
+def benchmark_soak(timers=100000, xhrs=100000):
+    pages = {
+        "soak": "<div></div><script src=/soak.js></script>",
+        "soak.js": SOAK_JS.format(
+            timers=timers, xhrs=xhrs,
+            concurrency=MAX_CONCURRENT_FETCHES),
+        "xhr": "ok",
+    }
+    server = FixtureServer({}, pages)
+    browser = headless_browser()
+    start = time.perf_counter()
+    browser.new_tab(server.url("soak"))
+    tab = browser.active_tab
+
+    stats = {}
+    def read_stats(ready):
+        stats["values"] = tab.js.interp.evaljs(SOAK_STATS_JS)
+        ready.set()
+
+    while True:
+        browser.composite_raster_and_draw()
+        browser.schedule_animation_frame()
+        ready = threading.Event()
+        tab.task_runner.schedule_task(Task(read_stats, ready))
+        ready.wait()
+        (done, target, timer_entries, xhr_entries, listener_entries) = \
+            stats["values"]
+        if done >= target: break
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - start
+
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} timers, {} XHRs in {:.2f}s".format(timers, xhrs, elapsed))
+    print("  live entries: timers={} xhrs={} listeners={}".format(
+        timer_entries, xhr_entries, listener_entries))
+    print("  max RSS: {:.1f}MB".format(max_rss_kb / 1024))
+    browser.handle_quit()
+    return {
+        "seconds": elapsed,
+        "timer_entries": timer_entries,
+        "xhr_entries": xhr_entries,
+        "listener_entries": listener_entries,
+        "max_rss_kb": max_rss_kb,
+    }
+
+def benchmark_navigation(runs=20):
+    corpus = {"small": CORPUS["small"]}
+    server = FixtureServer(corpus)
+    results = {}
+    for name, pool_size in [("cold", 0), ("pooled", INTERPRETER_POOL_SIZE)]:
+        browser = headless_browser()
+        browser.interpreter_pool.size = pool_size
+        browser.interpreter_pool.ready.clear()
+        browser.interpreter_pool.fill()
+        durations = {"js_context": [], "load": []}
+        for i in range(runs):
+            start = time.perf_counter()
+            if not browser.tabs:
+                browser.new_tab(server.url("small"))
+            else:
+                navigate(browser, server.url("small"))
+            if not wait_for_load(browser, "small"):
+                continue
+            durations["load"].append(time.perf_counter() - start)
+            durations["js_context"].extend(
+                browser.measure.take_durations().get("js_context", []))
+        print(name, browser.interpreter_pool.stats())
+        for stage, times in durations.items():
+            report("  " + stage, times)
+        results[name] = {
+            stage: summarize(times)
+            for stage, times in durations.items()
+        }
+        browser.handle_quit()
+    return results
+
+LONG_TASK_JS = """
+var count = 0;
+function callback() {{
+  for (var i = 0; i < {iterations}; i++);
+  var output = document.querySelectorAll("div")[0];
+  output.innerHTML = "count: " + count++;
+  if (count < {frames}) requestAnimationFrame(callback);
+}}
+requestAnimationFrame(callback);
+"""
+
+def benchmark_long_tasks(iterations=5000000, frames=10, budget=0.1):
+    pages = {
+        "longtask": "<div></div><script src=/longtask.js></script>",
+        "longtask.js": LONG_TASK_JS.format(
+            iterations=iterations, frames=frames),
+    }
+    server = FixtureServer({}, pages)
+    results = {}
+    for name, cpu_budget in [("unlimited", None), ("budgeted", budget)]:
+        browser = headless_browser()
+        browser.new_tab(server.url("longtask"))
+        browser.active_tab.task_runner.cpu_budget = cpu_budget
+        wait_for_load(browser, "longtask")
+        long_tasks = browser.active_tab.long_task_report()
+        durations = [entry["duration"] for entry in long_tasks["entries"]]
+        print("{}: {} tasks, {} long, {} interrupted, "
+              "total blocking time {:.2f}ms".format(
+              name, long_tasks["tasks"], long_tasks["long_tasks"],
+              long_tasks["interrupted"],
+              long_tasks["total_blocking_time"] * 1000))
+        if durations:
+            report("  long task", durations)
+        results[name] = {"long_task": summarize(durations)}
+        browser.handle_quit()
+    return results
+
+def benchmark_input_latency(background_tasks=2000, inputs=50,
+                            task_time=0.001):
+    task_runner = TaskRunner(None)
+    task_runner.start_thread()
+
+    def background():
+        end = time.perf_counter() + task_time
+        while time.perf_counter() < end: pass
+
+    done = threading.Event()
+    handled = []
+    def handle_input():
+        handled.append(1)
+        if len(handled) == inputs:
+            done.set()
+
+    for i in range(background_tasks):
+        priority = TASK_PRIORITY_NORMAL if i % 2 else TASK_PRIORITY_IDLE
+        task_runner.schedule_task(Task(background), priority)
+    for i in range(inputs):
+        task_runner.schedule_task(Task(handle_input), TASK_PRIORITY_INPUT)
+        time.sleep(task_time * 10)
+    done.wait()
+    while not task_runner.is_idle():
+        time.sleep(0.01)
+    task_runner.set_needs_quit()
+
+    results = {}
+    for priority, delays in task_runner.take_queue_delays().items():
+        if not delays: continue
+        report("{} queueing delay".format(priority), delays)
+        results[priority] = summarize(delays)
+    return results
+
+def poll_iteration(browser):
+    browser.composite_raster_and_draw()
+    browser.schedule_animation_frame()
+
+def wait_iteration(browser):
+    browser.wakeup.wait(browser.wait_timeout())
+    browser.wakeup.clear()
+    if browser.frame_clock.tick():
+        browser.composite_raster_and_draw()
+        browser.schedule_animation_frame()
+
+def benchmark_idle(seconds=3):
+    server = FixtureServer({}, {"idle": "<p>idle</p>"})
+    browser = open_page(server, "idle")
+    results = {}
+    for name, iteration in [
+        ("polling", poll_iteration), ("event-driven", wait_iteration)]:
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        iterations = 0
+        while time.perf_counter() - start < seconds:
+            iteration(browser)
+            iterations += 1
+        elapsed = time.perf_counter() - start
+        cpu_percent = (time.process_time() - start_cpu) / elapsed * 100
+        print("{}: {:.1f}% CPU, {} loop iterations in {:.1f}s".format(
+            name, cpu_percent, iterations, elapsed))
+        results[name] = {
+            "cpu_percent": cpu_percent,
+            "iterations": iterations,
+        }
+    browser.handle_quit()
+    return results
+
+def benchmark_frames(iterations=500000, frames=100):
+    pages = {
+        "frames": "<div></div><script src=/frames.js></script>",
+        "frames.js": LONG_TASK_JS.format(
+            iterations=iterations, frames=frames),
+    }
+    server = FixtureServer({}, pages)
+    browser = open_page(server, "frames")
+    stats = browser.frame_stats.stats()
+    print("{} frames drawn, {} dropped".format(
+        stats["frames"], stats["dropped"]))
+    print("  histogram", stats["histogram"])
+    results = {}
+    for key in ["frame_times", "input_to_commit", "commit_to_draw"]:
+        if not stats[key]: continue
+        report("  " + key, stats[key])
+        results[key] = summarize(stats[key])
+    browser.handle_quit()
+    return results
+
+BACKGROUND_JS = """
+var ticks = 0;
+setInterval(function () {{ ticks++; }}, {interval});
+"""
+
+def benchmark_background(seconds=3, interval_ms=1):
+    pages = {
+        "busy": "<p>busy</p><script src=/busy.js></script>",
+        "busy.js": BACKGROUND_JS.format(interval=interval_ms),
+        "other": "<p>other</p>",
+    }
+    server = FixtureServer({}, pages)
+    browser = open_page(server, "busy")
+    busy_tab = browser.active_tab
+
+    def count_ticks():
+        ticks = {}
+        ready = threading.Event()
+        def read_ticks():
+            ticks["value"] = busy_tab.js.interp.evaljs("ticks")
+            ready.set()
+        busy_tab.task_runner.schedule_task(Task(read_ticks))
+        ready.wait()
+        return ticks["value"]
+
+    results = {}
+    for name in ["foreground", "background"]:
+        if name == "background":
+            browser.new_tab(server.url("other"))
+            wait_for_load(browser, "other")
+        start_ticks = count_ticks()
+        start_cpu = time.process_time()
+        time.sleep(seconds)
+        cpu_percent = (time.process_time() - start_cpu) / seconds * 100
+        ticks = count_ticks() - start_ticks
+        print("{}: {} timer callbacks in {}s, {:.1f}% CPU".format(
+            name, ticks, seconds, cpu_percent))
+        results[name] = {"ticks": ticks, "cpu_percent": cpu_percent}
+    browser.lock.acquire(blocking=True)
+    print("tabs", browser.tab_stats())
+    browser.lock.release()
+    browser.handle_quit()
+    return results
+
+SPIN_JS = """
+for (var i = 0; i < {iterations}; i++);
+var request = new XMLHttpRequest();
+request.open("GET", "/done", false);
+request.send();
+"""
+
+def benchmark_processes(tabs=4, iterations=20000000):
+    pages = {
+        "spin": "<p>spin</p><script src=/spin.js></script>",
+        "spin.js": SPIN_JS.format(iterations=iterations),
+    }
+    server = FixtureServer({}, pages)
+    results = {}
+    for name, process_per_tab in [("threads", False), ("processes", True)]:
+        server.requested.clear()
+        browser = headless_browser(process_per_tab=process_per_tab)
+        start = time.perf_counter()
+        for i in range(tabs):
+            browser.new_tab(server.url("spin"))
+        while server.requested.count("done") < tabs:
+            if time.perf_counter() - start > LOAD_TIMEOUT_SEC:
+                print("Timed out waiting for {} tabs".format(name))
+                FAILURES.append("load " + name)
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        print("{}: {} tabs in {:.2f}s".format(name, tabs, elapsed))
+        results[name] = {"elapsed": elapsed * 1000}
+        browser.handle_quit()
+    return results
+
+def raster_display_list(display_list, height):
+    surface = skia.Surface(WIDTH, height)
+    canvas = surface.getCanvas()
+    canvas.clear(skia.ColorWHITE)
+    if isinstance(display_list, EncodedDisplayList):
+        display_list.execute(canvas)
+    else:
+        for cmd in display_list:
+            cmd.execute(canvas)
+    return surface
+
+def benchmark_display_list(page="small", runs=20):
+    server = FixtureServer(CORPUS)
+    browser = open_page(server, page)
+    display_list = browser.active_tab_display_list
+    height = math.ceil(browser.active_tab_height)
+    browser.handle_quit()
+
+    encode_times = []
+    decode_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        encoded = encode_display_list(display_list)
+        encode_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        encoded.decode()
+        decode_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    decoded = encoded.decode()
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    encoded_bytes = encoded.nbytes()
+    pickled_bytes = len(pickle.dumps(encoded))
+    print("{}: {} ops, {} strings, {} fonts".format(
+        page, len(encoded.ops), len(encoded.strings), len(encoded.fonts)))
+    print("  objects: {} bytes (Python heap only)".format(object_bytes))
+    print("  encoded: {} bytes, {} pickled".format(
+        encoded_bytes, pickled_bytes))
+
+    results = {
+        "encode": summarize(encode_times),
+        "decode": summarize(decode_times),
+        "object_bytes": object_bytes,
+        "encoded_bytes": encoded_bytes,
+    }
+    report("  encode", encode_times)
+    report("  decode", decode_times)
+    snapshots = {}
+    for name, form in [("objects", display_list), ("encoded", encoded)]:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            surface = raster_display_list(form, height)
+            times.append(time.perf_counter() - start)
+        snapshots[name] = surface.makeImageSnapshot().tobytes()
+        report("  execute " + name, times)
+        results["execute_" + name] = summarize(times)
+    check("pixel identical", snapshots["objects"] == snapshots["encoded"])
+    return results
+
+TRANSFORM_JS = """
+var count = 0;
+function callback() {{
+  var divs = document.querySelectorAll("div");
+  divs[0].style = "transform:translate(" + count * 7 + "px," +
+    count * 3 + "px)";
+  divs[1].innerHTML = "count: " + count++;
+  if (count < {frames}) requestAnimationFrame(callback);
+}}
+requestAnimationFrame(callback);
+"""
+
+def benchmark_damage(frames=50, paragraphs=40):
+    page = "<div></div>"
+    for i in range(paragraphs):
+        page += "<p>" + make_text(40) + "</p>"
+    pages = {
+        "damage": page + "<script src=/damage.js></script>",
+        "damage.js": LONG_TASK_JS.format(iterations=0, frames=frames),
+        "final": page.replace(
+            "<div></div>", "<div>count: {}</div>".format(frames - 1)),
+        "transform": "<div>moving</div>" + page +
+            "<script src=/transform.js></script>",
+        "transform.js": TRANSFORM_JS.format(frames=frames),
+    }
+    server = FixtureServer({}, pages)
+    browser = open_page(server, "damage")
+    stats = browser.frame_stats.stats()
+    areas = stats["damage_areas"][1:]
+    viewport_area = WIDTH * (HEIGHT - browser.chrome.bottom)
+    durations = browser.measure.take_durations()
+    print("{} composites, {} tiles rastered".format(
+        len(stats["damage_areas"]), browser.tile_cache.rastered_count))
+    if areas:
+        print("  damage area: p50={:.0f}px ({:.1f}% of viewport)".format(
+            statistics.median(areas),
+            statistics.median(areas) / viewport_area * 100))
+    results = {"damage_area": statistics.median(areas) if areas else None}
+    for stage in ["diff", "composite", "raster"]:
+        if durations.get(stage):
+            report("  " + stage, durations[stage])
+            results[stage] = summarize(durations[stage])
+
+    content = skia.IRect.MakeLTRB(
+        0, math.ceil(browser.chrome.bottom), WIDTH, HEIGHT)
+    before = browser.root_surface.makeImageSnapshot(content).tobytes()
+    browser.handle_quit()
+    browser = open_page(server, "final")
+    after = browser.root_surface.makeImageSnapshot(content).tobytes()
+    check("matches full raster", before == after)
+    browser.handle_quit()
+
+    browser = open_page(server, "transform")
+    check("transform change matches full raster",
+        matches_full_raster(browser))
+    browser.handle_quit()
+    return results
+
+class MouseEvent:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+def benchmark_typing(text="hello browser", paragraphs=40):
+    page = "<input>"
+    for i in range(paragraphs):
+        page += "<p>" + make_text(40) + "</p>"
+    server = FixtureServer({}, {"typing": page})
+    browser = open_page(server, "typing")
+    browser.handle_click(MouseEvent(
+        HSTEP + 5, browser.chrome.bottom + VSTEP + 5))
+    wait_for_load(browser, "typing")
+
+    rastered = []
+    drawn = []
+    for char in text:
+        pixels = browser.tile_cache.rastered_pixels
+        draws = len(browser.frame_stats.draw_areas)
+        browser.handle_key(char)
+        wait_for_load(browser, "typing")
+        rastered.append(browser.tile_cache.rastered_pixels - pixels)
+        drawn.append(sum(list(browser.frame_stats.draw_areas)[draws:]))
+    viewport_area = WIDTH * (HEIGHT - browser.chrome.bottom)
+    print("{} keystrokes, {} skipped draws".format(
+        len(text), browser.frame_stats.skipped_draws))
+    print("  rastered per keystroke: p50={:.0f}px ({:.1f}% of viewport)"
+        .format(statistics.median(rastered),
+            statistics.median(rastered) / viewport_area * 100))
+    print("  drawn per keystroke: p50={:.0f}px ({:.1f}% of window)"
+        .format(statistics.median(drawn),
+            statistics.median(drawn) / (WIDTH * HEIGHT) * 100))
+
+    check("matches full raster", matches_full_raster(browser))
+    browser.handle_quit()
+    return {
+        "rastered_pixels": statistics.median(rastered),
+        "drawn_pixels": statistics.median(drawn),
+    }
+
+def benchmark_culling(lengths=[25, 100, 400], runs=10):
+    pages = {}
+    for paragraphs in lengths:
+        random.seed(paragraphs)
+        pages["culling{}".format(paragraphs)] = \
+            ("<p>" + make_text(20) + "</p>") * paragraphs
+    server = FixtureServer({}, pages)
+    results = {}
+    for name in pages:
+        browser = open_page(server, name)
+        commands = sum(len(tree_to_list(item, []))
+            for item in browser.active_tab_display_list)
+        browser.measure.take_durations()
+        for _ in range(runs):
+            force_full_raster(browser)
+        durations = browser.measure.take_durations()
+        print("{}: {} paint commands, {:.0f}px tall".format(
+            name, commands, browser.active_tab_height))
+        results[name] = {"commands": commands}
+        for stage in ["raster", "draw"]:
+            report("  " + stage, durations[stage])
+            results[name][stage] = summarize(durations[stage])
+        browser.handle_quit()
+    return results
+
+BENCHMARKS = {
+    "pages": benchmark_pages,
+    "composite": benchmark_composite,
+    "timers": benchmark_timers,
+    "soak": benchmark_soak,
+    "navigation": benchmark_navigation,
+    "longtasks": benchmark_long_tasks,
+    "input": benchmark_input_latency,
+    "idle": benchmark_idle,
+    "frames": benchmark_frames,
+    "background": benchmark_background,
+    "processes": benchmark_processes,
+    "displaylist": benchmark_display_list,
+    "damage": benchmark_damage,
+    "typing": benchmark_typing,
+    "culling": benchmark_culling,
+}
+
+REGRESSION_THRESHOLD = 1.10
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    regressions = 0
+    for benchmark, old_results in old.items():
+        for key, old_value in flatten(old_results):
+            new_value = dict(flatten(new.get(benchmark, {}))).get(key)
+            if not old_value or new_value == None: continue
+            ratio = new_value / old_value
+            marker = ""
+            if ratio > REGRESSION_THRESHOLD:
+                marker = "  <-- regression"
+                regressions += 1
+            print("{} {}: {:.2f}ms -> {:.2f}ms ({:+.0f}%){}".format(
+                benchmark, key, old_value, new_value,
+                (ratio - 1) * 100, marker))
+    return regressions
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + ".")
+        elif key in ["p50", "p95"] and value != None:
+            yield prefix + key, value
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--compare":
+        sys.exit(1 if compare(args[1], args[2]) else 0)
+    output = None
+    if "--output" in args:
+        i = args.index("--output")
+        output = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    results = {}
+    for name in args or list(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    if FAILURES:
+        print("Failed checks:", ", ".join(FAILURES))
+        sys.exit(1)
@@ -1,17 +1,29 @@
+import array
+import collections
 import ctypes
 import gtts
+import hashlib
+import heapq
 import math
+import multiprocessing
+import multiprocessing.shared_memory
 import os
+import pickle
 import playsound3
-import sdl2
 import skia
 import socket
 import ssl
 import threading
 import time
 import urllib.parse
+import weakref
 import dukpy
-import OpenGL.GL
+
+try:
+    import sdl2
+    import OpenGL.GL
+except ImportError:
+    sdl2 = None
 
 COOKIE_JAR = {}
 
@@ -125,6 +137,222 @@ class URL:
             port_part = ""
         return self.scheme + "://" + self.host + port_part + self.path
 
+FETCH_PRIORITY_DOCUMENT = 0
+FETCH_PRIORITY_SUBRESOURCE = 1
+FETCH_PRIORITY_XHR = 2
+
+MAX_CONCURRENT_FETCHES = 6
+MAX_CONCURRENT_XHRS = 4
+
+class FetchRequest:
+    def __init__(self, url, referrer, payload, priority, owner, callback):
+        self.url = url
+        self.referrer = referrer
+        self.payload = payload
+        self.priority = priority
+        self.owner = owner
+        self.callback = callback
+        self.cancelled = False
+        self.response = None
+        self.error = None
+        self.elapsed = 0
+        self.done = threading.Event()
+
+    def run(self):
+        start = time.time()
+        try:
+            self.response = self.url.request(self.referrer, self.payload)
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.time() - start
+        self.done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.error = Exception("Fetch cancelled")
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.response
+
+SCRIPT_CACHE_SIZE = 64
+
+def cache_max_age(headers):
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        if "=" in directive:
+            directive, value = directive.split("=", 1)
+        else:
+            value = None
+        directives[directive.strip().casefold()] = value
+    if "no-store" in directives or "no-cache" in directives:
+        return None
+    try:
+        return int(directives["max-age"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class ScriptCache:
+    def __init__(self, size=SCRIPT_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.unchanged = 0
+        self.bytes_saved = 0
+        self.fetch_time_saved = 0
+
+    def get(self, url):
+        key = str(url)
+        self.lock.acquire(blocking=True)
+        entry = self.entries.pop(key, None)
+        body = None
+        if entry and entry["expires"] > time.time():
+            self.entries[key] = entry
+            self.hits += 1
+            self.bytes_saved += len(entry["body"])
+            self.fetch_time_saved += entry["fetch_time"]
+            body = entry["body"]
+        else:
+            self.misses += 1
+            if entry:
+                self.entries[key] = entry
+        self.lock.release()
+        return body
+
+    def put(self, url, headers, body, fetch_time):
+        key = str(url)
+        content_hash = hashlib.sha256(body.encode("utf8")).hexdigest()
+        max_age = cache_max_age(headers)
+        self.lock.acquire(blocking=True)
+        old = self.entries.pop(key, None)
+        if old and old["hash"] == content_hash:
+            self.unchanged += 1
+        if max_age:
+            self.entries[key] = {
+                "hash": content_hash,
+                "body": body,
+                "expires": time.time() + max_age,
+                "fetch_time": fetch_time,
+            }
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+        self.lock.release()
+
+    def stats(self):
+        self.lock.acquire(blocking=True)
+        stats = {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "unchanged": self.unchanged,
+            "bytes_saved": self.bytes_saved,
+            "fetch_time_saved": self.fetch_time_saved,
+        }
+        self.lock.release()
+        return stats
+
+class FetchExecutor:
+    def __init__(self, num_workers=MAX_CONCURRENT_FETCHES,
+                 max_xhrs=MAX_CONCURRENT_XHRS):
+        self.queue = []
+        self.count = 0
+        self.in_flight = set()
+        self.max_xhrs = max_xhrs
+        self.condition = threading.Condition()
+        self.needs_quit = False
+        self.num_workers = 0
+        for i in range(num_workers):
+            self.start_worker()
+
+    def start_worker(self):
+        worker = threading.Thread(
+            target=self.run,
+            name="Fetch thread {}".format(self.num_workers),
+            daemon=True,
+        )
+        self.num_workers += 1
+        worker.start()
+
+    def fetch(self, url, referrer, payload=None,
+              priority=FETCH_PRIORITY_XHR, owner=None, callback=None):
+        request = FetchRequest(
+            url, referrer, payload, priority, owner, callback)
+        self.condition.acquire(blocking=True)
+        heapq.heappush(self.queue, (priority, self.count, request))
+        self.count += 1
+        self.condition.notify()
+        self.condition.release()
+        return request
+
+    def cancel(self, owner):
+        self.condition.acquire(blocking=True)
+        queued = [entry for entry in self.queue
+                  if entry[2].owner is owner]
+        self.queue = [entry for entry in self.queue
+                      if entry[2].owner is not owner]
+        heapq.heapify(self.queue)
+        in_flight = [request for request in self.in_flight
+                     if request.owner is owner]
+        # A cancelled request's worker may stay blocked on its socket,
+        # so it retires when the request returns and a new worker
+        # takes its slot now.
+        for request in in_flight:
+            self.in_flight.discard(request)
+            self.start_worker()
+        self.condition.release()
+        for (priority, count, request) in queued:
+            request.cancel()
+        for request in in_flight:
+            request.cancel()
+
+    def set_needs_quit(self):
+        self.condition.acquire(blocking=True)
+        self.needs_quit = True
+        self.condition.notify_all()
+        self.condition.release()
+
+    def next_request(self):
+        if not self.queue: return None
+        (priority, count, request) = self.queue[0]
+        if priority == FETCH_PRIORITY_XHR:
+            xhrs = [request for request in self.in_flight
+                    if request.priority == FETCH_PRIORITY_XHR]
+            if len(xhrs) >= self.max_xhrs: return None
+        heapq.heappop(self.queue)
+        return request
+
+    def run(self):
+        while True:
+            self.condition.acquire(blocking=True)
+            request = self.next_request()
+            while not request and not self.needs_quit:
+                self.condition.wait()
+                request = self.next_request()
+            if self.needs_quit:
+                self.condition.release()
+                return
+            self.in_flight.add(request)
+            self.condition.release()
+
+            request.run()
+
+            self.condition.acquire(blocking=True)
+            retired = request not in self.in_flight
+            self.in_flight.discard(request)
+            self.condition.notify()
+            self.condition.release()
+            if retired: return
+            if request.callback and not request.cancelled:
+                try:
+                    request.callback(request)
+                except Exception as e:
+                    print("Fetch callback for", request.url, "crashed", e)
+
 def tree_to_list(tree, list):
     list.append(tree)
     for child in tree.children:
@@ -132,9 +360,11 @@ def tree_to_list(tree, list):
     return list
 
 class MeasureTime:
-    def __init__(self):
+    def __init__(self, path="browser.trace"):
         self.lock = threading.Lock()
-        self.file = open("browser.trace", "w")
+        self.starts = {}
+        self.durations = None
+        self.file = open(path, "w")
         self.file.write('{"traceEvents": [')
         ts = time.time() * 1000000
         self.file.write(
@@ -149,6 +379,8 @@ class MeasureTime:
         ts = time.time() * 1000000
         tid = threading.get_ident()
         self.lock.acquire(blocking=True)
+        if self.durations != None:
+            self.starts[(tid, name)] = ts
         self.file.write(
             ', { "ph": "B", "cat": "_",' +
             '"name": "' + name + '",' +
@@ -161,6 +393,10 @@ class MeasureTime:
         ts = time.time() * 1000000
         tid = threading.get_ident()
         self.lock.acquire(blocking=True)
+        if (tid, name) in self.starts:
+            start = self.starts.pop((tid, name))
+            self.durations.setdefault(name, []).append(
+                (ts - start) / 1000000)
         self.file.write(
             ', { "ph": "E", "cat": "_",' +
             '"name": "' + name + '",' +
@@ -169,6 +405,34 @@ class MeasureTime:
         self.file.flush()
         self.lock.release()
 
+    def collect_durations(self):
+        self.lock.acquire(blocking=True)
+        if self.durations == None:
+            self.durations = {}
+        self.lock.release()
+
+    def take_durations(self):
+        self.lock.acquire(blocking=True)
+        durations = self.durations or {}
+        if self.durations != None:
+            self.durations = {}
+        self.lock.release()
+        return durations
+
+    def counter(self, name, values):
+        ts = time.time() * 1000000
+        args = ", ".join(
+            '"' + key + '": ' + str(value)
+            for key, value in values.items())
+        self.lock.acquire(blocking=True)
+        self.file.write(
+            ', { "ph": "C", "cat": "_",' +
+            '"name": "' + name + '",' +
+            '"ts": ' + str(ts) + ',' +
+            '"pid": 1, "args": {' + args + '}}')
+        self.file.flush()
+        self.lock.release()
+
     def finish(self):
         self.lock.acquire(blocking=True)
         for thread in threading.enumerate():
@@ -181,53 +445,154 @@ class MeasureTime:
         self.lock.release()
 
 EVENT_DISPATCH_JS = \
-    "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
-SETTIMEOUT_JS = "__runSetTimeout(dukpy.handle)"
+    "__dispatchEvent(dukpy.handle, dukpy.type)"
+SETTIMEOUT_JS = "__runSetTimeout(dukpy.handle, dukpy.repeat)"
 XHR_ONLOAD_JS = "__runXHROnload(dukpy.out, dukpy.handle)"
+XHR_ONERROR_JS = "__runXHROnerror(dukpy.handle)"
+IDLE_CALLBACK_JS = \
+    "__runIdleCallback(dukpy.handle, dukpy.deadline, dukpy.did_timeout)"
+FLUSH_MUTATIONS_JS = "__flushMutations()"
+RAF_HANDLERS_JS = "__runRAFHandlers()"
+
+RUNTIME_JS = open("runtime.js").read()
+INTERPRETER_POOL_SIZE = 2
+
+def make_interpreter():
+    interp = dukpy.JSInterpreter()
+    # End on null so the runtime's completion value never has to be
+    # converted, whatever its last statement happens to be.
+    interp.evaljs(RUNTIME_JS + "\nnull;")
+    return interp
+
+class InterpreterPool:
+    def __init__(self, size=INTERPRETER_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.ready = []
+        self.hits = 0
+        self.misses = 0
 
-RUNTIME_JS = open("runtim.js").read()
+    def acquire(self):
+        self.lock.acquire(blocking=True)
+        interp = self.ready.pop() if self.ready else None
+        if interp:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+        if not interp:
+            interp = make_interpreter()
+        return interp
+
+    def fill(self):
+        while True:
+            self.lock.acquire(blocking=True)
+            needed = len(self.ready) < self.size
+            self.lock.release()
+            if not needed: return
+            interp = make_interpreter()
+            self.lock.acquire(blocking=True)
+            self.ready.append(interp)
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire(blocking=True)
+        stats = {
+            "ready": len(self.ready),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+        self.lock.release()
+        return stats
 
 class JSContext:
-    def __init__(self, tab):
+    def __init__(self, tab, interp=None):
         self.tab = tab
         self.discarded = False
 
-        self.interp = dukpy.JSInterpreter()
-        self.interp.export_function("log", print)
-        self.interp.export_function("querySelectorAll",
+        self.bridge_calls = 0
+
+        self.interp = interp or make_interpreter()
+        self.export_function("log", print)
+        self.export_function("querySelectorAll",
             self.querySelectorAll)
-        self.interp.export_function("getAttribute",
+        self.export_function("getAttribute",
             self.getAttribute)
-        self.interp.export_function("setAttribute",
-            self.setAttribute)
-        self.interp.export_function("innerHTML_set", self.innerHTML_set)
-        self.interp.export_function("style_set", self.style_set)
-        self.interp.export_function("XMLHttpRequest_send",
+        self.export_function("apply_mutations", self.apply_mutations,
+            check_budget=False)
+        self.export_function("XMLHttpRequest_send",
             self.XMLHttpRequest_send)
-        self.interp.export_function("setTimeout",
+        self.export_function("setTimeout",
             self.setTimeout)
-        self.interp.export_function("requestAnimationFrame",
+        self.export_function("setInterval",
+            self.setInterval)
+        self.export_function("clearTimeout",
+            self.clearTimeout)
+        self.export_function("requestAnimationFrame",
             self.requestAnimationFrame)
-        self.interp.evaljs(RUNTIME_JS)
+        self.export_function("requestIdleCallback",
+            self.requestIdleCallback)
+        self.export_function("cancelIdleCallback",
+            self.cancelIdleCallback)
 
         self.node_to_handle = {}
         self.handle_to_node = {}
+        self.next_handle = 0
+        self.timers = {}
+        self.idle_callbacks = {}
+        self.selector_cache = {}
+        self.tag_index = None
+        self.query_cache = {}
+
+    def export_function(self, name, function, check_budget=True):
+        def bridge_call(*args):
+            self.bridge_calls += 1
+            if check_budget:
+                self.tab.task_runner.check_budget()
+            return function(*args)
+        self.interp.export_function(name, bridge_call)
+
+    def take_bridge_calls(self):
+        bridge_calls = self.bridge_calls
+        self.bridge_calls = 0
+        return bridge_calls
+
+    def call_js(self, code, **kwargs):
+        self.tab.task_runner.start_script()
+        try:
+            return self.interp.evaljs(code, **kwargs)
+        except dukpy.JSRuntimeError:
+            self.tab.task_runner.script_stopped()
+            raise
 
     def run(self, script, code):
         try:
-            return self.interp.evaljs(code)
+            return self.call_js(code)
         except dukpy.JSRuntimeError as e:
             print("Script", script, "crashed", e)
+        finally:
+            self.interp.evaljs(FLUSH_MUTATIONS_JS)
+
+    def run_raf_handlers(self):
+        try:
+            self.call_js(RAF_HANDLERS_JS)
+        except dukpy.JSRuntimeError as e:
+            print("requestAnimationFrame callback crashed", e)
 
     def dispatch_event(self, type, elt):
         handle = self.node_to_handle.get(elt, -1)
-        do_default = self.interp.evaljs(
-            EVENT_DISPATCH_JS, type=type, handle=handle)
+        try:
+            do_default = self.call_js(
+                EVENT_DISPATCH_JS, type=type, handle=handle)
+        except dukpy.JSRuntimeError as e:
+            print("Event handler for", type, "crashed", e)
+            return False
         return not do_default
 
     def get_handle(self, elt):
         if elt not in self.node_to_handle:
-            handle = len(self.node_to_handle)
+            handle = self.next_handle
+            self.next_handle += 1
             self.node_to_handle[elt] = handle
             self.handle_to_node[handle] = elt
         else:
@@ -235,41 +600,120 @@ class JSContext:
         return handle
 
     def querySelectorAll(self, selector_text):
-        selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                 in tree_to_list(self.tab.nodes, [])
-                 if selector.matches(node)]
+        if selector_text not in self.query_cache:
+            if selector_text not in self.selector_cache:
+                self.selector_cache[selector_text] = \
+                    CSSParser(selector_text).selector()
+            selector = self.selector_cache[selector_text]
+            candidates = self.get_tag_index().get(selector.key_tag(), [])
+            self.query_cache[selector_text] = (selector, [
+                node for node in candidates if selector.matches(node)])
+        (selector, nodes) = self.query_cache[selector_text]
         return [self.get_handle(node) for node in nodes]
 
+    def get_tag_index(self):
+        if self.tag_index == None:
+            self.tag_index = {}
+            for node in tree_to_list(self.tab.nodes, []):
+                if isinstance(node, Element):
+                    self.tag_index.setdefault(node.tag, []).append(node)
+        return self.tag_index
+
+    def update_tag_index(self, elt, removed_nodes, added_nodes):
+        changed_tags = set([node.tag
+            for node in removed_nodes + added_nodes
+            if isinstance(node, Element)])
+        if self.tag_index != None:
+            removed = set(removed_nodes)
+            elt_key = document_order_key(elt)
+            for tag in changed_tags:
+                nodes = [node for node in self.tag_index.get(tag, [])
+                         if node not in removed]
+                lo, hi = 0, len(nodes)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if document_order_key(nodes[mid]) > elt_key:
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                nodes[lo:lo] = [node for node in added_nodes
+                    if isinstance(node, Element) and node.tag == tag]
+                self.tag_index[tag] = nodes
+        for selector_text, (selector, nodes) in \
+            list(self.query_cache.items()):
+            if selector.key_tag() in changed_tags:
+                del self.query_cache[selector_text]
+
+    def invalidate_focus_queries(self):
+        for selector_text, (selector, nodes) in \
+            list(self.query_cache.items()):
+            if selector.uses_focus():
+                del self.query_cache[selector_text]
+
     def getAttribute(self, handle, attr):
-        elt = self.handle_to_node[handle]
+        elt = self.handle_to_node.get(handle)
+        if not elt: return ""
         attr = elt.attributes.get(attr, None)
         return attr if attr else ""
 
+    def apply_mutations(self, mutations):
+        removed = []
+        for mutation in mutations:
+            if mutation[0] == "setAttribute":
+                self.setAttribute(*mutation[1:])
+            elif mutation[0] == "innerHTML":
+                removed.extend(self.innerHTML_set(*mutation[1:]))
+            elif mutation[0] == "style":
+                self.style_set(*mutation[1:])
+        if mutations:
+            self.tab.set_needs_render()
+        return removed
+
     def setAttribute(self, handle, attr, value):
-        elt = self.handle_to_node[handle]
+        elt = self.handle_to_node.get(handle)
+        if not elt: return
         elt.attributes[attr] = value
-        self.tab.set_needs_render()
+
+    def release_handles(self, nodes):
+        removed = []
+        for child in nodes:
+            for node in tree_to_list(child, []):
+                if node in self.node_to_handle:
+                    handle = self.node_to_handle.pop(node)
+                    del self.handle_to_node[handle]
+                    removed.append(handle)
+        return removed
 
     def innerHTML_set(self, handle, s):
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
-        elt = self.handle_to_node[handle]
+        elt = self.handle_to_node.get(handle)
+        if not elt: return []
+        removed = self.release_handles(elt.children)
+        removed_nodes = [node for child in elt.children
+                         for node in tree_to_list(child, [])]
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.set_needs_render()
+        added_nodes = [node for child in elt.children
+                       for node in tree_to_list(child, [])]
+        self.update_tag_index(elt, removed_nodes, added_nodes)
+        return removed
 
     def style_set(self, handle, s):
-        elt = self.handle_to_node[handle]
+        elt = self.handle_to_node.get(handle)
+        if not elt: return
         elt.attributes["style"] = s;
-        self.tab.set_needs_render()
 
     def dispatch_xhr_onload(self, out, handle):
         if self.discarded: return
-        do_default = self.interp.evaljs(
+        do_default = self.call_js(
             XHR_ONLOAD_JS, out=out, handle=handle)
 
+    def dispatch_xhr_onerror(self, handle):
+        if self.discarded: return
+        self.call_js(XHR_ONERROR_JS, handle=handle)
+
     def XMLHttpRequest_send(
         self, method, url, body, isasync, handle):
         full_url = self.tab.url.resolve(url)
@@ -286,24 +730,87 @@ class JSContext:
             if not isasync:
                 return response
 
+        def on_load(request):
+            if request.error:
+                task = Task(self.dispatch_xhr_onerror, handle)
+            else:
+                headers, response = request.response
+                task = Task(self.dispatch_xhr_onload, response, handle)
+            self.tab.task_runner.schedule_task(task)
+
         if not isasync:
             return run_load()
         else:
-            threading.Thread(target=run_load).start()
+            self.tab.browser.fetcher.fetch(
+                full_url, self.tab.url, body,
+                FETCH_PRIORITY_XHR, self, on_load)
 
-    def dispatch_settimeout(self, handle):
+    def dispatch_settimeout(self, handle, repeat=False):
         if self.discarded: return
-        self.interp.evaljs(SETTIMEOUT_JS, handle=handle)
+        if not repeat:
+            self.timers.pop(handle, None)
+        try:
+            self.call_js(SETTIMEOUT_JS, handle=handle, repeat=repeat)
+        except dukpy.JSRuntimeError as e:
+            print("Timer callback crashed", e)
 
     def setTimeout(self, handle, time):
-        def run_callback():
-            task = Task(self.dispatch_settimeout, handle)
-            self.tab.task_runner.schedule_task(task)
-        threading.Timer(time / 1000.0, run_callback).start()
+        self.timers[handle] = self.tab.timers.set_timer(
+            time / 1000.0, self.dispatch_settimeout, handle)
+
+    def setInterval(self, handle, time):
+        self.timers[handle] = self.tab.timers.set_timer(
+            time / 1000.0, self.dispatch_settimeout, handle, True,
+            repeat=True)
+
+    def clearTimeout(self, handle):
+        if handle in self.timers:
+            self.tab.timers.clear_timer(self.timers.pop(handle))
+
+    def clear_timers(self):
+        for timer_id in self.timers.values():
+            self.tab.timers.clear_timer(timer_id)
+        self.timers = {}
+        for timer_id in self.idle_callbacks.values():
+            if timer_id != None:
+                self.tab.timers.clear_timer(timer_id)
+        self.idle_callbacks = {}
 
     def requestAnimationFrame(self):
+        self.tab.needs_raf_callbacks = True
         self.tab.browser.set_needs_animation_frame(self.tab)
 
+    def dispatch_idle_callback(self, handle, did_timeout):
+        if self.discarded: return
+        if handle not in self.idle_callbacks: return
+        timer_id = self.idle_callbacks.pop(handle)
+        if timer_id != None and not did_timeout:
+            self.tab.timers.clear_timer(timer_id)
+        remaining = 0
+        if not did_timeout:
+            remaining = max(0,
+                self.tab.task_runner.idle_deadline - time.perf_counter())
+        deadline = (time.time() + remaining) * 1000
+        try:
+            self.call_js(IDLE_CALLBACK_JS, handle=handle,
+                deadline=deadline, did_timeout=did_timeout)
+        except dukpy.JSRuntimeError as e:
+            print("Idle callback crashed", e)
+
+    def requestIdleCallback(self, handle, timeout):
+        timer_id = None
+        if timeout > 0:
+            timer_id = self.tab.timers.set_timer(
+                timeout / 1000.0, self.dispatch_idle_callback, handle, True)
+        self.idle_callbacks[handle] = timer_id
+        task = Task(self.dispatch_idle_callback, handle, False)
+        self.tab.task_runner.schedule_task(task, TASK_PRIORITY_IDLE)
+
+    def cancelIdleCallback(self, handle):
+        timer_id = self.idle_callbacks.pop(handle, None)
+        if timer_id != None:
+            self.tab.timers.clear_timer(timer_id)
+
 def parse_transform(transform_str):
     if transform_str.find('translate(') < 0:
         return None
@@ -449,6 +956,12 @@ class TagSelector:
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    def key_tag(self):
+        return self.tag
+
+    def uses_focus(self):
+        return False
+
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
@@ -462,6 +975,13 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def key_tag(self):
+        return self.descendant.key_tag()
+
+    def uses_focus(self):
+        return self.ancestor.uses_focus() or \
+            self.descendant.uses_focus()
+
 class PseudoclassSelector:
     def __init__(self, pseudoclass, base):
         self.pseudoclass = pseudoclass
@@ -476,6 +996,12 @@ class PseudoclassSelector:
         else:
             return False
 
+    def key_tag(self):
+        return self.base.key_tag()
+
+    def uses_focus(self):
+        return True
+
 class Text:
     def __init__(self, text, parent):
         self.text = text
@@ -503,6 +1029,13 @@ class Element:
     def __repr__(self):
         return "<" + self.tag + ">"
 
+def document_order_key(node):
+    key = []
+    while node.parent:
+        key.append(node.parent.children.index(node))
+        node = node.parent
+    return key[::-1]
+
 def print_tree(node, indent=0):
     print(" " * indent, node)
     for child in node.children:
@@ -613,6 +1146,7 @@ HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 
 FONTS = {}
+FONT_STYLES = {}
 
 def get_font(size, weight, style):
     key = (weight, style)
@@ -630,8 +1164,13 @@ def get_font(size, weight, style):
             skia.FontStyle(skia_weight, skia_width, skia_style)
         font = skia.Typeface('Arial', style_info)
         FONTS[key] = font
+        FONT_STYLES[font.uniqueID()] = key
     return skia.Font(FONTS[key], size)
 
+def font_key(font):
+    (weight, style) = FONT_STYLES[font.getTypeface().uniqueID()]
+    return (font.getSize(), weight, style)
+
 NAMED_COLORS = {
     "black": "#000000",
     "gray":  "#808080",
@@ -692,13 +1231,39 @@ class NumericAnimation:
         self.frame_count = 1
         total_change = self.new_value - self.old_value
         self.change_per_frame = total_change / num_frames
+        self.value = str(self.old_value)
 
     def animate(self):
         self.frame_count += 1
         if self.frame_count >= self.num_frames: return
         current_value = self.old_value + \
             self.change_per_frame * self.frame_count
-        return str(current_value)
+        self.value = str(current_value)
+        return self.value
+
+class TranslateAnimation:
+    def __init__(self, old_value, new_value, num_frames):
+        (self.old_x, self.old_y) = parse_transform(old_value)
+        (self.new_x, self.new_y) = parse_transform(new_value)
+        self.num_frames = num_frames
+
+        self.frame_count = 1
+        self.change_x_per_frame = (self.new_x - self.old_x) / num_frames
+        self.change_y_per_frame = (self.new_y - self.old_y) / num_frames
+        self.value = old_value
+
+    def animate(self):
+        self.frame_count += 1
+        if self.frame_count >= self.num_frames: return
+        x = self.old_x + self.change_x_per_frame * self.frame_count
+        y = self.old_y + self.change_y_per_frame * self.frame_count
+        self.value = "translate({}px, {}px)".format(x, y)
+        return self.value
+
+COMPOSITED_ANIMATIONS = {
+    "opacity": NumericAnimation,
+    "transform": TranslateAnimation,
+}
 
 INHERITED_PROPERTIES = {
     "font-size": "16px",
@@ -744,12 +1309,16 @@ def style(node, rules, tab):
         transitions = diff_styles(old_style, node.style)
         for property, (old_value, new_value, num_frames) \
             in transitions.items():
-            if property == "opacity":
-                tab.set_needs_render()
-                animation = NumericAnimation(
-                    old_value, new_value, num_frames)
-                node.animations[property] = animation
-                node.style[property] = animation.animate()
+            if property not in COMPOSITED_ANIMATIONS: continue
+            if property == "transform" and not (
+                parse_transform(old_value) and
+                parse_transform(new_value)):
+                continue
+            animation = COMPOSITED_ANIMATIONS[property](
+                old_value, new_value, num_frames)
+            node.animations[property] = animation
+            tab.animating_nodes.add(node)
+            tab.new_animations.append((node, property, animation))
 
 def get_tabindex(node):
     tabindex = int(node.attributes.get("tabindex", "9999999"))
@@ -775,8 +1344,12 @@ def paint_visual_effects(node, cmds, rect):
         ]))
 
     blend_op = Blend(opacity, blend_mode, node, cmds)
-    node.blend_op = blend_op
-    return [Transform(translation, rect, node, [blend_op])]
+    if "opacity" in node.animations:
+        blend_op.needs_compositing = True
+    transform = Transform(translation, rect, node, [blend_op])
+    if "transform" in node.animations:
+        transform.needs_compositing = True
+    return [transform]
 
 def parse_outline(outline_str):
     if not outline_str: return None
@@ -1251,6 +1824,25 @@ def parse_blend_mode(blend_mode_str):
     else:
         return skia.BlendMode.kSrcOver
 
+# Paint can land outside a command's rect: strokes by half their
+# width and glyphs by their overhang.
+INK_OVERFLOW = 4
+
+def visible_bounds(item):
+    if isinstance(item, VisualEffect):
+        return item.visible_bounds()
+    return item.rect
+
+def execute_visible(items, canvas):
+    clip = canvas.getLocalClipBounds().makeOutset(
+        INK_OVERFLOW, INK_OVERFLOW)
+    for item in items:
+        if isinstance(item, Blend) and \
+            item.blend_mode == "destination-in":
+            item.execute(canvas)
+        elif skia.Rect.Intersects(visible_bounds(item), clip):
+            item.execute(canvas)
+
 class PaintCommand:
     def __init__(self, rect):
         self.rect = rect
@@ -1258,16 +1850,26 @@ class PaintCommand:
 
 class VisualEffect:
     def __init__(self, rect, children, node=None):
-        self.rect = rect.makeOffset(0.0, 0.0)
+        self.base_rect = rect.makeOffset(0.0, 0.0)
         self.children = children
-        for child in self.children:
-            self.rect.join(child.rect)
+        self.update_rect()
         self.node = node
         self.needs_compositing = any([
             child.needs_compositing for child in self.children
             if isinstance(child, VisualEffect)
         ])
 
+    def update_rect(self):
+        self.rect = self.base_rect.makeOffset(0.0, 0.0)
+        for child in self.children:
+            self.rect.join(child.rect)
+        self.visible_rect = None
+
+    def visible_bounds(self):
+        if not self.visible_rect:
+            self.visible_rect = self.map(self.rect)
+        return self.visible_rect
+
 class Blend(VisualEffect):
     def __init__(self, opacity, blend_mode, node, children):
         super().__init__(skia.Rect.MakeEmpty(), children, node)
@@ -1289,8 +1891,7 @@ class Blend(VisualEffect):
         )
         if self.should_save:
             canvas.saveLayer(None, paint)
-        for cmd in self.children:
-            cmd.execute(canvas)
+        execute_visible(self.children, canvas)
         if self.should_save:
             canvas.restore()
 
@@ -1355,8 +1956,7 @@ class Transform(VisualEffect):
             (x, y) = self.translation
             canvas.save()
             canvas.translate(x, y)
-        for cmd in self.children:
-            cmd.execute(canvas)
+        execute_visible(self.children, canvas)
         if self.translation:
             canvas.restore()
 
@@ -1470,7 +2070,14 @@ class DrawCompositedLayer(PaintCommand):
     def execute(self, canvas):
         layer = self.composited_layer
         bounds = layer.composited_bounds()
-        layer.surface.draw(canvas, bounds.left(), bounds.top())
+        clip = canvas.getLocalClipBounds()
+        for (col, row), surface in layer.tiles.items():
+            x = bounds.left() + col * TILE_SIZE
+            y = bounds.top() + row * TILE_SIZE
+            if not skia.Rect.Intersects(clip, skia.Rect.MakeXYWH(
+                x, y, surface.width(), surface.height())):
+                continue
+            surface.draw(canvas, x, y)
 
     def __repr__(self):
         return "DrawCompositedLayer()"
@@ -1487,30 +2094,186 @@ def paint_tree(layout_object, display_list):
         cmds = layout_object.paint_effects(cmds)
     display_list.extend(cmds)
 
+def display_item_key(item):
+    if isinstance(item, DrawText):
+        return (DrawText, rect_to_tuple(item.rect), item.text,
+            font_key(item.font), item.color)
+    elif isinstance(item, DrawRRect):
+        return (DrawRRect, rect_to_tuple(item.rect),
+            item.rrect.getSimpleRadii().x(), item.color)
+    elif isinstance(item, DrawOutline) or isinstance(item, DrawLine):
+        return (type(item), rect_to_tuple(item.rect),
+            item.color, item.thickness)
+    elif isinstance(item, DrawRect):
+        return (DrawRect, rect_to_tuple(item.rect), item.color)
+    elif isinstance(item, Blend):
+        return (Blend, item.node, item.opacity, item.blend_mode,
+            item.needs_compositing)
+    else:
+        return (Transform, item.node, item.translation,
+            rect_to_tuple(item.self_rect), item.needs_compositing)
+
+def map_to_absolute(ancestors, rect):
+    rect = rect.makeOffset(0.0, 0.0)
+    for ancestor in reversed(ancestors):
+        rect = ancestor.map(rect)
+    return rect
+
+def diff_children(old_children, new_children, path,
+                  old_ancestors, new_ancestors, patch, damage):
+    if len(old_children) != len(new_children): return False
+    for i, (old_item, new_item) in \
+        enumerate(zip(old_children, new_children)):
+        if display_item_key(old_item) == display_item_key(new_item):
+            if not isinstance(new_item, VisualEffect): continue
+            if diff_children(old_item.children, new_item.children,
+                path + (i,), old_ancestors + [old_item],
+                new_ancestors + [new_item], patch, damage):
+                continue
+        patch.append((path + (i,), new_item))
+        old_rect = map_to_absolute(old_ancestors, visible_bounds(old_item))
+        new_rect = map_to_absolute(new_ancestors, visible_bounds(new_item))
+        if not old_rect.isEmpty():
+            damage.append(old_rect)
+        if not new_rect.isEmpty() and new_rect != old_rect:
+            damage.append(new_rect)
+    return True
+
+def diff_display_lists(old, new):
+    patch = []
+    damage = []
+    if not diff_children(old, new, (), [], [], patch, damage):
+        return None
+    return (patch, damage)
+
+def patch_display_list(display_list, patch):
+    for (path, item) in patch:
+        ancestors = []
+        children = display_list
+        for index in path[:-1]:
+            ancestors.append(children[index])
+            children = children[index].children
+        children[path[-1]] = item
+        for effect in reversed(ancestors):
+            effect.update_rect()
+
+def update_effect_rects(items):
+    for item in items:
+        if isinstance(item, VisualEffect):
+            update_effect_rects(item.children)
+            item.update_rect()
+
+def damage_area(damage):
+    return sum([rect.width() * rect.height() for rect in damage])
+
 class Task:
-    def __init__(self, task_code, *args):
+    def __init__(self, task_code, *args, name=None):
         self.task_code = task_code
         self.args = args
+        self.name = name or task_code.__name__
 
     def run(self):
         self.task_code(*self.args)
         self.task_code = None
         self.args = None
 
+LONG_TASK_THRESHOLD_SEC = 0.05
+MAX_LONG_TASK_ENTRIES = 100
+SCRIPT_CPU_BUDGET_SEC = None
+
+class ScriptTimeout(Exception):
+    pass
+
+class LongTaskMonitor:
+    def __init__(self, threshold=LONG_TASK_THRESHOLD_SEC):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, url):
+        self.lock.acquire(blocking=True)
+        self.url = url
+        self.tasks = 0
+        self.task_time = 0
+        self.long_tasks = []
+        self.long_task_count = 0
+        self.long_task_time = 0
+        self.blocking_time = 0
+        self.interrupted = 0
+        self.lock.release()
+
+    def record(self, name, duration, cpu_time, interrupted):
+        self.lock.acquire(blocking=True)
+        self.tasks += 1
+        self.task_time += duration
+        if interrupted:
+            self.interrupted += 1
+        is_long = duration > self.threshold
+        if is_long:
+            self.long_task_count += 1
+            self.long_task_time += duration
+            self.blocking_time += duration - self.threshold
+            self.long_tasks.append({
+                "name": name,
+                "duration": duration,
+                "cpu_time": cpu_time,
+                "interrupted": interrupted,
+            })
+            if len(self.long_tasks) > MAX_LONG_TASK_ENTRIES:
+                self.long_tasks.pop(0)
+        self.lock.release()
+        return is_long
+
+    def report(self):
+        self.lock.acquire(blocking=True)
+        report = {
+            "url": str(self.url) if self.url else None,
+            "tasks": self.tasks,
+            "task_time": self.task_time,
+            "long_tasks": self.long_task_count,
+            "long_task_time": self.long_task_time,
+            "total_blocking_time": self.blocking_time,
+            "interrupted": self.interrupted,
+            "entries": list(self.long_tasks),
+        }
+        self.lock.release()
+        return report
+
+TASK_PRIORITY_INPUT = 0
+TASK_PRIORITY_RENDERING = 1
+TASK_PRIORITY_NORMAL = 2
+TASK_PRIORITY_IDLE = 3
+TASK_PRIORITIES = ["input", "rendering", "normal", "idle"]
+
+TASK_STARVATION_LIMIT = 8
+IDLE_PERIOD_MAX_SEC = 0.05
+MAX_QUEUE_DELAY_SAMPLES = 10000
+
 class TaskRunner:
     def __init__(self, tab):
         self.tab = tab
-        self.tasks = []
+        self.queues = [collections.deque() for _ in TASK_PRIORITIES]
+        self.skipped = [0 for _ in TASK_PRIORITIES]
+        self.delays = [collections.deque(maxlen=MAX_QUEUE_DELAY_SAMPLES)
+                       for _ in TASK_PRIORITIES]
         self.condition = threading.Condition()
         self.main_thread = threading.Thread(
             target=self.run,
             name="Main thread",
         )
         self.needs_quit = False
-
-    def schedule_task(self, task):
+        self.running = False
+        self.long_tasks = LongTaskMonitor()
+        self.cpu_budget = SCRIPT_CPU_BUDGET_SEC
+        self.task_cpu_start = None
+        self.script_cpu_start = None
+        self.budget_exceeded = False
+        self.interrupted = False
+        self.idle_deadline = None
+
+    def schedule_task(self, task, priority=TASK_PRIORITY_NORMAL):
         self.condition.acquire(blocking=True)
-        self.tasks.append(task)
+        self.queues[priority].append((time.perf_counter(), task))
         self.condition.notify_all()
         self.condition.release()
 
@@ -1522,37 +2285,224 @@ class TaskRunner:
 
     def clear_pending_tasks(self):
         self.condition.acquire(blocking=True)
-        self.tasks.clear()
+        for queue in self.queues:
+            queue.clear()
         self.condition.release()
 
     def start_thread(self):
         self.main_thread.start()
 
+    def next_task(self):
+        chosen = None
+        for priority, queue in enumerate(self.queues):
+            if not queue: continue
+            if chosen == None:
+                chosen = priority
+            elif priority != TASK_PRIORITY_IDLE:
+                self.skipped[priority] += 1
+                if self.skipped[priority] > TASK_STARVATION_LIMIT:
+                    chosen = priority
+                    break
+        if chosen == None:
+            return None
+        if chosen == TASK_PRIORITY_IDLE:
+            self.idle_deadline = self.tab.idle_deadline() if self.tab \
+                else time.perf_counter() + IDLE_PERIOD_MAX_SEC
+            if self.idle_deadline <= time.perf_counter():
+                return None
+        self.skipped[chosen] = 0
+        enqueued, task = self.queues[chosen].popleft()
+        self.delays[chosen].append(time.perf_counter() - enqueued)
+        return task
+
     def run(self):
+        self.condition.acquire(blocking=True)
         while True:
-            self.condition.acquire(blocking=True)
-            needs_quit = self.needs_quit
-            self.condition.release()
-            if needs_quit:
+            if self.needs_quit:
+                self.condition.release()
                 self.handle_quit()
                 return
 
-            task = None
-            self.condition.acquire(blocking=True)
-            if len(self.tasks) > 0:
-                task = self.tasks.pop(0)
-            self.condition.release()
-            if task:
-                task.run()
+            task = self.next_task()
+            if not task:
+                timeout = None
+                if self.queues[TASK_PRIORITY_IDLE]:
+                    timeout = IDLE_PERIOD_MAX_SEC
+                self.condition.wait(timeout)
+                continue
 
-            self.condition.acquire(blocking=True)
-            if len(self.tasks) == 0 and not self.needs_quit:
-                self.condition.wait()
+            self.running = True
             self.condition.release()
+            self.run_task(task)
+            self.condition.acquire(blocking=True)
+            self.running = False
+
+    def run_task(self, task):
+        name = task.name
+        start = time.perf_counter()
+        self.task_cpu_start = time.thread_time()
+        self.script_cpu_start = None
+        self.budget_exceeded = False
+        self.interrupted = False
+        try:
+            task.run()
+        except dukpy.JSRuntimeError as e:
+            if not self.interrupted: raise
+            print("Task", name, "interrupted:", e)
+        cpu_time = time.thread_time() - self.task_cpu_start
+        duration = time.perf_counter() - start
+        self.task_cpu_start = None
+        self.script_cpu_start = None
+        if self.long_tasks.record(
+            name, duration, cpu_time, self.interrupted) and self.tab:
+            self.tab.browser.measure.counter("Long task", {
+                "duration": duration, "cpu_time": cpu_time})
+
+    def start_script(self):
+        self.script_cpu_start = time.thread_time()
+
+    def check_budget(self):
+        if self.cpu_budget == None or self.script_cpu_start == None:
+            return
+        # Scripts can catch ScriptTimeout, so once the budget trips
+        # every later bridge call in the task fails too.
+        if not self.budget_exceeded and \
+            time.thread_time() - self.script_cpu_start <= self.cpu_budget:
+            return
+        self.budget_exceeded = True
+        raise ScriptTimeout(
+            "Script exceeded CPU budget of {}s".format(self.cpu_budget))
+
+    def script_stopped(self):
+        if self.budget_exceeded:
+            self.interrupted = True
+
+    def is_idle(self):
+        self.condition.acquire(blocking=True)
+        idle = not any(self.queues) and not self.running
+        self.condition.release()
+        return idle
+
+    def take_queue_delays(self):
+        self.condition.acquire(blocking=True)
+        delays = {}
+        for name, samples in zip(TASK_PRIORITIES, self.delays):
+            delays[name] = list(samples)
+            samples.clear()
+        self.condition.release()
+        return delays
+
+    def queue_lengths(self):
+        self.condition.acquire(blocking=True)
+        lengths = {name: len(queue)
+                   for name, queue in zip(TASK_PRIORITIES, self.queues)}
+        self.condition.release()
+        return lengths
 
     def handle_quit(self):
         pass
 
+MIN_INTERVAL_SEC = 0.001
+BACKGROUND_TIMER_ALIGNMENT_SEC = 1
+
+class TimerService:
+    def __init__(self, task_runner):
+        self.task_runner = task_runner
+        self.heap = []
+        self.timers = {}
+        self.next_id = 0
+        self.condition = threading.Condition()
+        self.needs_quit = False
+        self.alignment = None
+        self.thread = threading.Thread(
+            target=self.run,
+            name="Timer thread",
+            daemon=True,
+        )
+
+    def start_thread(self):
+        self.thread.start()
+
+    def set_timer(self, delay, callback, *args, repeat=False):
+        self.condition.acquire(blocking=True)
+        timer_id = self.next_id
+        self.next_id += 1
+        interval = max(delay, MIN_INTERVAL_SEC) if repeat else None
+        deadline = time.monotonic() + max(delay, 0)
+        self.timers[timer_id] = (deadline, interval, callback, args)
+        heapq.heappush(self.heap, (deadline, timer_id))
+        self.condition.notify_all()
+        self.condition.release()
+        return timer_id
+
+    def clear_timer(self, timer_id):
+        self.condition.acquire(blocking=True)
+        self.timers.pop(timer_id, None)
+        self.condition.release()
+
+    def set_alignment(self, alignment):
+        self.condition.acquire(blocking=True)
+        self.alignment = alignment
+        self.condition.notify_all()
+        self.condition.release()
+
+    def set_needs_quit(self):
+        self.condition.acquire(blocking=True)
+        self.needs_quit = True
+        self.condition.notify_all()
+        self.condition.release()
+
+    def next_wakeup(self):
+        wakeup = self.heap[0][0]
+        if self.alignment:
+            # Align to wall-clock boundaries so that every background
+            # tab, in any process, wakes up at the same moments.
+            offset = time.time() - time.monotonic()
+            wakeup = max(wakeup, math.ceil(
+                (wakeup + offset) / self.alignment) * self.alignment - offset)
+        return wakeup
+
+    def run(self):
+        while True:
+            self.condition.acquire(blocking=True)
+            while not self.needs_quit:
+                now = time.monotonic()
+                if self.heap and self.next_wakeup() <= now: break
+                timeout = self.next_wakeup() - now if self.heap else None
+                self.condition.wait(timeout)
+            if self.needs_quit:
+                self.condition.release()
+                return
+
+            batches = {}
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, timer_id = heapq.heappop(self.heap)
+                if timer_id not in self.timers: continue
+                (timer_deadline, interval, callback, args) = \
+                    self.timers[timer_id]
+                if timer_deadline != deadline: continue
+                batch = 0 if self.alignment else int(deadline * 1000)
+                batches.setdefault(batch, []).append((callback, args))
+                if interval:
+                    deadline += interval
+                    if deadline <= now:
+                        deadline = now + interval
+                    self.timers[timer_id] = \
+                        (deadline, interval, callback, args)
+                    heapq.heappush(self.heap, (deadline, timer_id))
+                else:
+                    del self.timers[timer_id]
+            self.condition.release()
+
+            for ms in sorted(batches):
+                task = Task(self.run_timers, batches[ms])
+                self.task_runner.schedule_task(task)
+
+    def run_timers(self, timers):
+        for (callback, args) in timers:
+            callback(*args)
+
 def is_focusable(node):
     if get_tabindex(node) < 0:
         return False
@@ -1576,6 +2526,9 @@ class Tab:
         self.tab_height = tab_height
         self.focus = None
         self.js = None
+        self.nodes = None
+        self.committed_display_list = None
+        self.display_list_version = 0
         self.browser = browser
         self.needs_accessibility = False
         self.needs_style = False
@@ -1583,22 +2536,70 @@ class Tab:
         self.needs_paint = False
         self.needs_focus_scroll = False
         self.task_runner = TaskRunner(self)
+        self.timers = TimerService(self.task_runner)
         self.document = None
         self.task_runner.start_thread()
+        self.timers.start_thread()
 
         self.accessibility_tree = None
+        self.accessibility_task_scheduled = False
 
-        self.composited_updates = []
+        self.background = False
+        self.inactive_since = None
+        self.discarded = False
+
+        self.new_animations = []
+        self.animating_nodes = set()
+        self.needs_raf_callbacks = False
 
     def allowed_request(self, url):
         return self.allowed_origins == None or \
             url.origin() in self.allowed_origins
 
+    def long_task_report(self):
+        return self.task_runner.long_tasks.report()
+
+    def set_background(self, background):
+        self.background = background
+        self.inactive_since = time.time() if background else None
+        self.timers.set_alignment(
+            BACKGROUND_TIMER_ALIGNMENT_SEC if background else None)
+
+    def discard(self):
+        if self.js:
+            self.browser.fetcher.cancel(self.js)
+            self.js.discarded = True
+            self.js.clear_timers()
+            self.js = None
+        self.nodes = None
+        self.rules = None
+        self.document = None
+        self.display_list = []
+        self.committed_display_list = None
+        self.accessibility_tree = None
+        self.focus = None
+        self.animating_nodes = set()
+        self.new_animations = []
+        self.needs_raf_callbacks = False
+        self.needs_style = False
+        self.needs_layout = False
+        self.needs_paint = False
+        self.needs_accessibility = False
+
+    def restore(self):
+        url = self.history.pop()
+        self.load(url)
+
     def load(self, url, payload=None):
         self.focus_element(None)
-        headers, body = url.request(self.url, payload)
+        if self.js:
+            self.browser.fetcher.cancel(self.js)
+        request = self.browser.fetcher.fetch(
+            url, self.url, payload, FETCH_PRIORITY_DOCUMENT)
+        headers, body = request.wait()
         self.history.append(url)
         self.url = url
+        self.task_runner.long_tasks.reset(url)
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_tab = True
@@ -1611,45 +2612,77 @@ class Tab:
                 for origin in csp[1:]:
                     self.allowed_origins.append(URL(origin).origin())
 
+        self.browser.measure.time('parse')
         self.nodes = HTMLParser(body).parse()
-
-        if self.js: self.js.discarded = True
-        self.js = JSContext(self)
+        self.browser.measure.stop('parse')
+        self.animating_nodes = set()
+        self.needs_raf_callbacks = False
+        self.needs_accessibility = False
+        self.accessibility_task_scheduled = False
+
+        if self.js:
+            self.js.discarded = True
+            self.js.clear_timers()
+        self.browser.measure.time('js_context')
+        self.js = JSContext(self, self.browser.interpreter_pool.acquire())
+        self.browser.measure.stop('js_context')
         scripts = [node.attributes["src"] for node
                    in tree_to_list(self.nodes, [])
                    if isinstance(node, Element)
                    and node.tag == "script"
                    and "src" in node.attributes]
+        script_requests = []
         for script in scripts:
             script_url = url.resolve(script)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
-            try:
-                headers, body = script_url.request(url)
-            except:
+            body = self.browser.script_cache.get(script_url)
+            if body is not None:
+                script_requests.append((script_url, None, body))
                 continue
-            task = Task(self.js.run, script_url, body)
-            self.task_runner.schedule_task(task)
+            script_requests.append((script_url, self.browser.fetcher.fetch(
+                script_url, url, priority=FETCH_PRIORITY_SUBRESOURCE,
+                owner=self.js), None))
 
-        self.rules = DEFAULT_STYLE_SHEET.copy()
         links = [node.attributes["href"]
                  for node in tree_to_list(self.nodes, [])
                  if isinstance(node, Element)
                  and node.tag == "link"
                  and node.attributes.get("rel") == "stylesheet"
                  and "href" in node.attributes]
+        style_requests = []
         for link in links:
             style_url = url.resolve(link)
             if not self.allowed_request(style_url):
                 print("Blocked style", link, "due to CSP")
                 continue
+            style_requests.append(self.browser.fetcher.fetch(
+                style_url, url, priority=FETCH_PRIORITY_SUBRESOURCE,
+                owner=self.js))
+
+        for script_url, request, body in script_requests:
+            if request:
+                try:
+                    headers, body = request.wait()
+                except:
+                    continue
+                self.browser.script_cache.put(
+                    script_url, headers, body, request.elapsed)
+            task = Task(self.js.run, script_url, body,
+                name="script " + str(script_url))
+            self.task_runner.schedule_task(task)
+
+        self.rules = DEFAULT_STYLE_SHEET.copy()
+        for request in style_requests:
             try:
-                headers, body = style_url.request(url)
+                headers, body = request.wait()
             except:
                 continue
             self.rules.extend(CSSParser(body).parse())
         self.set_needs_render()
+        self.task_runner.schedule_task(
+            Task(self.browser.interpreter_pool.fill), TASK_PRIORITY_IDLE)
 
     def set_needs_render(self):
         self.needs_style = True
@@ -1668,19 +2701,19 @@ class Tab:
         maxscroll = height - self.tab_height
         return max(0, min(scroll, maxscroll))
 
-    def run_animation_frame(self, scroll):
+    def run_animation_frame(self, scroll, display_list_version=None):
+        if not self.nodes:
+            self.browser.commit(self, CommitData(
+                self.url, None, 0, None, {}, None, None, [],
+                None, None, None))
+            return
         if not self.scroll_changed_in_tab:
             self.scroll = scroll
-        self.js.interp.evaljs("__runRAFHandlers()")
-
-        for node in tree_to_list(self.nodes, []):
-            for (property_name, animation) in \
-                node.animations.items():
-                value = animation.animate()
-                if value:
-                    node.style[property_name] = value
-                    self.composited_updates.append(node)
-                    self.set_needs_paint()
+        if self.needs_raf_callbacks:
+            self.needs_raf_callbacks = False
+            self.js.run_raf_handlers()
+        self.browser.measure.counter(
+            "Bridge calls", {"calls": self.js.take_bridge_calls()})
 
         needs_composite = self.needs_style or self.needs_layout
 
@@ -1696,25 +2729,50 @@ class Tab:
         composited_updates = None
         if not needs_composite:
             composited_updates = {}
-            for node in self.composited_updates:
-                composited_updates[node] = node.blend_op
-        self.composited_updates = []
+        display_list = self.display_list
+        display_list_patch = None
+        damage = None
+        if display_list:
+            if needs_composite and self.committed_display_list and \
+                display_list_version == self.display_list_version:
+                self.browser.measure.time('diff')
+                diff = diff_display_lists(
+                    self.committed_display_list, display_list)
+                self.browser.measure.stop('diff')
+                if diff:
+                    (display_list_patch, damage) = diff
+                    display_list = None
+            self.committed_display_list = self.display_list
+            self.display_list_version += 1
         document_height = math.ceil(self.document.height + 2*VSTEP)
         commit_data = CommitData(
             self.url, scroll, document_height,
-            self.display_list,
+            display_list,
             composited_updates,
             self.accessibility_tree,
-            self.focus)
+            self.focus,
+            self.new_animations,
+            display_list_patch,
+            damage,
+            self.display_list_version)
         self.display_list = None
+        self.new_animations = []
         self.browser.commit(self, commit_data)
         self.scroll_changed_in_tab = False
         self.accessibility_tree = None
 
+    def finish_animations(self, finished):
+        for (node, property, animation) in finished:
+            if node.animations.get(property) is animation:
+                del node.animations[property]
+            if not node.animations:
+                self.animating_nodes.discard(node)
+
     def render(self):
         self.browser.measure.time('render')
 
         if self.needs_style:
+            self.browser.measure.time('style')
             if self.dark_mode:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
@@ -1722,26 +2780,32 @@ class Tab:
             style(self.nodes, sorted(self.rules, key=cascade_priority), self)
             self.needs_layout = True
             self.needs_style = False
+            self.browser.measure.stop('style')
 
         if self.needs_layout:
+            self.browser.measure.time('layout')
             self.document = DocumentLayout(self.nodes)
             self.document.layout(self.zoom)
             self.needs_accessibility = True
             self.needs_paint = True
             self.needs_layout = False
+            self.browser.measure.stop('layout')
 
         if self.needs_accessibility:
-            self.accessibility_tree = AccessibilityNode(self.nodes)
-            self.accessibility_tree.build()
-            self.needs_accessibility = False
+            if self.browser.accessibility_is_on:
+                self.build_accessibility_tree()
+            elif not self.accessibility_task_scheduled:
+                self.accessibility_task_scheduled = True
+                self.task_runner.schedule_task(
+                    Task(self.idle_build_accessibility_tree),
+                    TASK_PRIORITY_IDLE)
 
         if self.needs_paint:
+            self.browser.measure.time('paint')
             self.display_list = []
             paint_tree(self.document, self.display_list)
             self.needs_paint = False
-
-            for item in self.display_list:
-                print_tree(item)
+            self.browser.measure.stop('paint')
 
         clamped_scroll = self.clamp_scroll(self.scroll)
         if clamped_scroll != self.scroll:
@@ -1751,7 +2815,36 @@ class Tab:
         self.browser.measure.stop('render')
 
 
+    def build_accessibility_tree(self):
+        self.browser.measure.time('accessibility')
+        self.accessibility_tree = AccessibilityNode(self.nodes)
+        self.accessibility_tree.build()
+        self.needs_accessibility = False
+        self.browser.measure.stop('accessibility')
+
+    def idle_build_accessibility_tree(self):
+        self.accessibility_task_scheduled = False
+        if not self.needs_accessibility: return
+        self.build_accessibility_tree()
+        tree = self.accessibility_tree
+        self.accessibility_tree = None
+        self.browser.commit_accessibility(self, tree)
+
+    def needs_rendering(self):
+        return self.needs_raf_callbacks or \
+            self.needs_style or \
+            self.needs_layout or \
+            self.needs_paint or \
+            bool(self.animating_nodes)
+
+    def idle_deadline(self):
+        deadline = time.perf_counter() + IDLE_PERIOD_MAX_SEC
+        if self.browser.active_tab == self and self.needs_rendering():
+            deadline = min(deadline, self.browser.frame_clock.next_frame)
+        return deadline
+
     def click(self, x, y):
+        if not self.nodes: return
         self.render()
         self.focus_element(None)
         y += self.scroll
@@ -1842,6 +2935,8 @@ class Tab:
         self.focus = node
         if node:
             node.is_focused = True
+        if self.js:
+            self.js.invalidate_focus_queries()
 #        self.set_needs_render()
 
     def activate_element(self, elt):
@@ -1875,6 +2970,7 @@ class Tab:
         self.scroll_changed_in_tab = True
 
     def advance_tab(self):
+        if not self.nodes: return
         focusable_nodes = [node
             for node in tree_to_list(self.nodes, [])
             if isinstance(node, Element) and is_focusable(node)]
@@ -1893,6 +2989,93 @@ class Tab:
         self.set_needs_render()
 
 REFRESH_RATE_SEC = .033
+MAX_IDLE_WAIT_SEC = 1
+
+FRAME_STATS_WINDOW = 120
+FRAME_HISTOGRAM_BUCKETS_MS = [8, 16, 33, 50, 100, 200]
+
+class FrameStats:
+    def __init__(self, window=FRAME_STATS_WINDOW):
+        self.frame_times = collections.deque(maxlen=window)
+        self.input_to_commit = collections.deque(maxlen=window)
+        self.commit_to_draw = collections.deque(maxlen=window)
+        self.damage_areas = collections.deque(maxlen=window)
+        self.draw_areas = collections.deque(maxlen=window)
+        self.frames = 0
+        self.dropped = 0
+        self.skipped_draws = 0
+
+    def record_input(self, latency):
+        self.input_to_commit.append(latency)
+
+    def record_draw(self, frame_time, commit_to_draw):
+        self.frames += 1
+        self.frame_times.append(frame_time)
+        self.commit_to_draw.append(commit_to_draw)
+
+    def record_dropped(self):
+        self.dropped += 1
+
+    def record_damage(self, area):
+        self.damage_areas.append(area)
+
+    def record_draw_area(self, area):
+        self.draw_areas.append(area)
+
+    def record_skipped_draw(self):
+        self.skipped_draws += 1
+
+    def histogram(self):
+        counts = {}
+        for bucket in FRAME_HISTOGRAM_BUCKETS_MS:
+            counts["<" + str(bucket) + "ms"] = 0
+        overflow = ">=" + str(FRAME_HISTOGRAM_BUCKETS_MS[-1]) + "ms"
+        counts[overflow] = 0
+        for frame_time in self.frame_times:
+            ms = frame_time * 1000
+            for bucket in FRAME_HISTOGRAM_BUCKETS_MS:
+                if ms < bucket:
+                    counts["<" + str(bucket) + "ms"] += 1
+                    break
+            else:
+                counts[overflow] += 1
+        return counts
+
+    def counters(self):
+        counters = self.histogram()
+        counters["frames"] = self.frames
+        counters["dropped"] = self.dropped
+        counters["skipped draws"] = self.skipped_draws
+        return counters
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "skipped_draws": self.skipped_draws,
+            "frame_times": list(self.frame_times),
+            "input_to_commit": list(self.input_to_commit),
+            "commit_to_draw": list(self.commit_to_draw),
+            "damage_areas": list(self.damage_areas),
+            "draw_areas": list(self.draw_areas),
+            "histogram": self.histogram(),
+        }
+
+class FrameClock:
+    def __init__(self, interval=REFRESH_RATE_SEC):
+        self.interval = interval
+        self.next_frame = time.perf_counter()
+
+    def time_until_frame(self):
+        return max(0, self.next_frame - time.perf_counter())
+
+    def tick(self):
+        now = time.perf_counter()
+        if now < self.next_frame:
+            return False
+        missed = math.floor((now - self.next_frame) / self.interval)
+        self.next_frame += (missed + 1) * self.interval
+        return True
 
 class Chrome:
     def __init__(self, browser):
@@ -2021,7 +3204,8 @@ class Chrome:
                     self.browser.set_active_tab(tab)
                     active_tab = self.browser.active_tab
                     task = Task(active_tab.set_needs_render)
-                    active_tab.task_runner.schedule_task(task)
+                    active_tab.task_runner.schedule_task(
+                        task, TASK_PRIORITY_RENDERING)
                     break
 
     def keypress(self, char):
@@ -2045,7 +3229,9 @@ class Chrome:
 
 class CommitData:
     def __init__(self, url, scroll, height, display_list,
-                 composited_updates, accessibility_tree, focus):
+                 composited_updates, accessibility_tree, focus,
+                 animations, display_list_patch, damage,
+                 display_list_version):
         self.url = url
         self.scroll = scroll
         self.height = height
@@ -2053,6 +3239,653 @@ class CommitData:
         self.composited_updates = composited_updates
         self.accessibility_tree = accessibility_tree
         self.focus = focus
+        self.animations = animations
+        self.display_list_patch = display_list_patch
+        self.damage = damage
+        self.display_list_version = display_list_version
+
+COMMIT_BUFFER_SIZE = 16 * 1024 * 1024
+TAB_PROCESS_QUIT_TIMEOUT_SEC = 1
+
+def rect_to_tuple(rect):
+    return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+DISPLAY_OP_TEXT = 0
+DISPLAY_OP_RRECT = 1
+DISPLAY_OP_RECT = 2
+DISPLAY_OP_OUTLINE = 3
+DISPLAY_OP_LINE = 4
+DISPLAY_OP_BLEND = 5
+DISPLAY_OP_TRANSFORM = 6
+DISPLAY_OP_END = 7
+
+class EncodedDisplayList:
+    def __init__(self, ops, floats, ints, strings, fonts):
+        self.ops = ops
+        self.floats = floats
+        self.ints = ints
+        self.strings = strings
+        self.fonts = fonts
+
+    def nbytes(self):
+        tables = self.strings + [
+            weight + style for (size, weight, style) in self.fonts]
+        return self.ops.itemsize * len(self.ops) + \
+            self.floats.itemsize * (len(self.floats) + len(self.fonts)) + \
+            self.ints.itemsize * len(self.ints) + \
+            sum([len(string.encode("utf8")) for string in tables])
+
+    def decode(self, get_node=lambda node_id: None):
+        fonts = [get_font(*font) for font in self.fonts]
+        strings = self.strings
+        floats = self.floats
+        ints = self.ints
+        display_list = []
+        children = display_list
+        stack = []
+        f = 0
+        i = 0
+        for op in self.ops:
+            if op == DISPLAY_OP_TEXT:
+                children.append(DrawText(floats[f], floats[f + 1],
+                    strings[ints[i]], fonts[ints[i + 1]],
+                    strings[ints[i + 2]]))
+                f += 2
+                i += 3
+            elif op == DISPLAY_OP_RRECT:
+                children.append(DrawRRect(
+                    skia.Rect.MakeLTRB(*floats[f:f + 4]),
+                    floats[f + 4], strings[ints[i]]))
+                f += 5
+                i += 1
+            elif op == DISPLAY_OP_RECT:
+                children.append(DrawRect(
+                    skia.Rect.MakeLTRB(*floats[f:f + 4]),
+                    strings[ints[i]]))
+                f += 4
+                i += 1
+            elif op == DISPLAY_OP_OUTLINE:
+                children.append(DrawOutline(
+                    skia.Rect.MakeLTRB(*floats[f:f + 4]),
+                    strings[ints[i]], floats[f + 4]))
+                f += 5
+                i += 1
+            elif op == DISPLAY_OP_LINE:
+                children.append(DrawLine(*floats[f:f + 4],
+                    strings[ints[i]], floats[f + 4]))
+                f += 5
+                i += 1
+            elif op == DISPLAY_OP_BLEND:
+                blend_mode = strings[ints[i]] if ints[i] >= 0 else None
+                stack.append((children, op,
+                    (floats[f], blend_mode), ints[i + 1], ints[i + 2]))
+                children = []
+                f += 1
+                i += 3
+            elif op == DISPLAY_OP_TRANSFORM:
+                translation = None
+                if ints[i + 2]:
+                    translation = (floats[f + 4], floats[f + 5])
+                stack.append((children, op,
+                    (translation, skia.Rect.MakeLTRB(*floats[f:f + 4])),
+                    ints[i], ints[i + 1]))
+                children = []
+                f += 6 if translation else 4
+                i += 3
+            else:
+                (parent, effect_op, args, node_id, needs_compositing) = \
+                    stack.pop()
+                node = get_node(node_id) if node_id >= 0 else None
+                if effect_op == DISPLAY_OP_BLEND:
+                    effect = Blend(*args, node, children)
+                else:
+                    effect = Transform(*args, node, children)
+                effect.needs_compositing = bool(needs_compositing)
+                parent.append(effect)
+                children = parent
+        return display_list
+
+    def execute(self, canvas):
+        fonts = [get_font(*font) for font in self.fonts]
+        colors = {}
+        strings = self.strings
+        floats = self.floats
+        ints = self.ints
+        restores = []
+        f = 0
+        i = 0
+        for op in self.ops:
+            if op == DISPLAY_OP_TEXT:
+                color = ints[i + 2]
+                if color not in colors:
+                    colors[color] = parse_color(strings[color])
+                font = fonts[ints[i + 1]]
+                paint = skia.Paint(AntiAlias=True, Color=colors[color])
+                baseline = floats[f + 1] - font.getMetrics().fAscent
+                canvas.drawString(strings[ints[i]], floats[f],
+                    baseline, font, paint)
+                f += 2
+                i += 3
+            elif op == DISPLAY_OP_BLEND:
+                opacity = floats[f]
+                blend_mode = strings[ints[i]] if ints[i] >= 0 else None
+                should_save = blend_mode or opacity < 1
+                if should_save:
+                    canvas.saveLayer(None, skia.Paint(
+                        Alphaf=opacity,
+                        BlendMode=parse_blend_mode(blend_mode)))
+                restores.append(should_save)
+                f += 1
+                i += 3
+            elif op == DISPLAY_OP_TRANSFORM:
+                if ints[i + 2]:
+                    canvas.save()
+                    canvas.translate(floats[f + 4], floats[f + 5])
+                restores.append(ints[i + 2])
+                f += 6 if ints[i + 2] else 4
+                i += 3
+            elif op == DISPLAY_OP_END:
+                if restores.pop():
+                    canvas.restore()
+            else:
+                color = ints[i]
+                if color not in colors:
+                    colors[color] = parse_color(strings[color])
+                rect = skia.Rect.MakeLTRB(*floats[f:f + 4])
+                if op == DISPLAY_OP_RRECT:
+                    radius = floats[f + 4]
+                    canvas.drawRRect(
+                        skia.RRect.MakeRectXY(rect, radius, radius),
+                        skia.Paint(Color=colors[color]))
+                    f += 5
+                elif op == DISPLAY_OP_RECT:
+                    canvas.drawRect(rect, skia.Paint(Color=colors[color]))
+                    f += 4
+                else:
+                    paint = skia.Paint(
+                        Color=colors[color],
+                        StrokeWidth=floats[f + 4],
+                        Style=skia.Paint.kStroke_Style,
+                    )
+                    if op == DISPLAY_OP_OUTLINE:
+                        canvas.drawRect(rect, paint)
+                    else:
+                        canvas.drawPath(skia.Path()
+                            .moveTo(rect.left(), rect.top())
+                            .lineTo(rect.right(), rect.bottom()), paint)
+                    f += 5
+                i += 1
+
+class DisplayListEncoder:
+    def __init__(self, node_id=lambda node: -1):
+        self.node_id = node_id
+        self.ops = array.array("B")
+        self.floats = array.array("f")
+        self.ints = array.array("i")
+        self.strings = []
+        self.string_ids = {}
+        self.fonts = []
+        self.font_ids = {}
+
+    def string(self, string):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def font(self, font):
+        key = font_key(font)
+        if key not in self.font_ids:
+            self.font_ids[key] = len(self.fonts)
+            self.fonts.append(key)
+        return self.font_ids[key]
+
+    def rect(self, rect):
+        self.floats.extend(
+            (rect.left(), rect.top(), rect.right(), rect.bottom()))
+
+    def node(self, node):
+        return -1 if node == None else self.node_id(node)
+
+    def add(self, item):
+        if isinstance(item, DrawText):
+            self.ops.append(DISPLAY_OP_TEXT)
+            self.floats.extend((item.rect.left(), item.rect.top()))
+            self.ints.extend((self.string(item.text),
+                self.font(item.font), self.string(item.color)))
+        elif isinstance(item, DrawRRect):
+            self.ops.append(DISPLAY_OP_RRECT)
+            self.rect(item.rect)
+            self.floats.append(item.rrect.getSimpleRadii().x())
+            self.ints.append(self.string(item.color))
+        elif isinstance(item, DrawRect):
+            self.ops.append(DISPLAY_OP_RECT)
+            self.rect(item.rect)
+            self.ints.append(self.string(item.color))
+        elif isinstance(item, DrawOutline):
+            self.ops.append(DISPLAY_OP_OUTLINE)
+            self.rect(item.rect)
+            self.floats.append(item.thickness)
+            self.ints.append(self.string(item.color))
+        elif isinstance(item, DrawLine):
+            self.ops.append(DISPLAY_OP_LINE)
+            self.rect(item.rect)
+            self.floats.append(item.thickness)
+            self.ints.append(self.string(item.color))
+        elif isinstance(item, Blend):
+            self.ops.append(DISPLAY_OP_BLEND)
+            self.floats.append(item.opacity)
+            blend_mode = -1
+            if item.blend_mode:
+                blend_mode = self.string(item.blend_mode)
+            self.ints.extend((blend_mode, self.node(item.node),
+                int(item.needs_compositing)))
+        elif isinstance(item, Transform):
+            self.ops.append(DISPLAY_OP_TRANSFORM)
+            self.rect(item.self_rect)
+            if item.translation:
+                self.floats.extend(item.translation)
+            self.ints.extend((self.node(item.node),
+                int(item.needs_compositing), int(bool(item.translation))))
+        else:
+            raise Exception("Cannot encode display item " + repr(item))
+        if isinstance(item, VisualEffect):
+            for child in item.children:
+                self.add(child)
+            self.ops.append(DISPLAY_OP_END)
+
+    def finish(self):
+        return EncodedDisplayList(self.ops, self.floats, self.ints,
+            self.strings, self.fonts)
+
+def encode_display_list(display_list, node_id=lambda node: -1):
+    encoder = DisplayListEncoder(node_id)
+    for item in display_list:
+        encoder.add(item)
+    return encoder.finish()
+
+def encode_accessibility_tree(tree, node_id):
+    return (node_id(tree.node), tree.role, getattr(tree, "text", None),
+        [rect_to_tuple(bound) for bound in tree.bounds],
+        [encode_accessibility_tree(child, node_id)
+         for child in tree.children])
+
+def decode_accessibility_tree(data, get_node):
+    (node_id, role, text, bounds, children) = data
+    tree = AccessibilityNode.__new__(AccessibilityNode)
+    tree.node = get_node(node_id)
+    tree.role = role
+    if text != None:
+        tree.text = text
+    tree.bounds = [skia.Rect.MakeLTRB(*bound) for bound in bounds]
+    tree.children = [decode_accessibility_tree(child, get_node)
+                     for child in children]
+    return tree
+
+class RemoteNode:
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+    def __repr__(self):
+        return "RemoteNode({})".format(self.node_id)
+
+class TabProcessBrowser:
+    def __init__(self, conn, buffer_name, buffer_free, dark_mode):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.buffer = multiprocessing.shared_memory.SharedMemory(
+            name=buffer_name)
+        self.buffer_free = buffer_free
+        self.measure = MeasureTime(os.devnull)
+        self.fetcher = FetchExecutor()
+        self.script_cache = ScriptCache()
+        self.interpreter_pool = InterpreterPool()
+        self.interpreter_pool.fill()
+        self.frame_clock = FrameClock()
+        self.dark_mode = dark_mode
+        self.accessibility_is_on = False
+        self.tab = None
+        self.active_tab = None
+
+        self.node_ids = weakref.WeakKeyDictionary()
+        self.next_node_id = 0
+        self.animations = {}
+        self.next_animation_id = 0
+
+    def send(self, *message):
+        self.send_lock.acquire(blocking=True)
+        self.conn.send(message)
+        self.send_lock.release()
+
+    def node_id(self, node):
+        if node == None: return None
+        if node not in self.node_ids:
+            self.node_ids[node] = self.next_node_id
+            self.next_node_id += 1
+        return self.node_ids[node]
+
+    def set_needs_animation_frame(self, tab):
+        if self.active_tab == tab:
+            self.send("needs_animation_frame")
+
+    def focus_addressbar(self):
+        self.send("focus_addressbar")
+
+    def commit_accessibility(self, tab, tree):
+        self.send("accessibility", pickle.dumps(
+            encode_accessibility_tree(tree, self.node_id)))
+
+    def commit(self, tab, data):
+        display_list = None
+        if data.display_list != None:
+            display_list = encode_display_list(
+                data.display_list, self.node_id)
+        display_list_patch = None
+        damage = None
+        if data.display_list_patch != None:
+            display_list_patch = [
+                (path, encode_display_list([item], self.node_id))
+                for (path, item) in data.display_list_patch]
+            damage = [rect_to_tuple(rect) for rect in data.damage]
+        composited_updates = None
+        if data.composited_updates != None:
+            composited_updates = [
+                (self.node_id(node), blend.opacity, blend.blend_mode)
+                for node, blend in data.composited_updates.items()]
+        accessibility_tree = None
+        if data.accessibility_tree:
+            accessibility_tree = encode_accessibility_tree(
+                data.accessibility_tree, self.node_id)
+        animations = []
+        for (node, property, animation) in data.animations:
+            animation_id = self.next_animation_id
+            self.next_animation_id += 1
+            self.animations[animation_id] = animation
+            animations.append(
+                (self.node_id(node), property, animation_id, animation))
+        payload = pickle.dumps((data.url, data.scroll, data.height,
+            display_list, composited_updates, accessibility_tree,
+            self.node_id(data.focus), animations, display_list_patch,
+            damage, data.display_list_version))
+
+        if len(payload) > self.buffer.size:
+            self.send("commit_inline", payload)
+            return
+        self.buffer_free.acquire()
+        self.buffer.buf[:len(payload)] = payload
+        self.send("commit_shared", len(payload))
+
+    def finish_animations(self, finished):
+        nodes = {node_id: node for node, node_id in self.node_ids.items()}
+        resolved = []
+        for (node_id, property, animation_id) in finished:
+            animation = self.animations.pop(animation_id, None)
+            if node_id in nodes and animation:
+                resolved.append((nodes[node_id], property, animation))
+        return resolved
+
+    def run(self, tab_height):
+        self.tab = Tab(self, tab_height)
+        while True:
+            message = self.conn.recv()
+            if message[0] == "task":
+                (_, name, args, priority, state) = message
+                self.accessibility_is_on = state["accessibility_is_on"]
+                self.frame_clock.next_frame = state["next_frame"]
+                if name == "finish_animations":
+                    args = (self.finish_animations(*args),)
+                task = Task(getattr(self.tab, name), *args)
+                self.tab.task_runner.schedule_task(task, priority)
+            elif message[0] == "clear_pending_tasks":
+                self.tab.task_runner.clear_pending_tasks()
+            elif message[0] == "is_idle":
+                self.send("idle", message[1],
+                    self.tab.task_runner.is_idle())
+            elif message[0] == "set_background":
+                self.active_tab = None if message[1] else self.tab
+                self.tab.set_background(message[1])
+            elif message[0] == "quit":
+                self.tab.task_runner.set_needs_quit()
+                self.tab.timers.set_needs_quit()
+                self.fetcher.set_needs_quit()
+                self.buffer.close()
+                return
+
+def run_tab_process(conn, buffer_name, buffer_free, tab_height, dark_mode):
+    threading.current_thread().name = "Tab process"
+    browser = TabProcessBrowser(conn, buffer_name, buffer_free, dark_mode)
+    browser.run(tab_height)
+
+TAB_PROCESS_TASKS = [
+    "load", "restore", "discard", "go_back", "click", "keypress", "enter",
+    "advance_tab", "zoom_by", "reset_zoom", "set_dark_mode",
+    "set_needs_paint", "set_needs_render", "run_animation_frame",
+    "finish_animations",
+]
+
+class TabProcessTaskRunner:
+    def __init__(self, tab):
+        self.tab = tab
+
+    def schedule_task(self, task, priority=TASK_PRIORITY_NORMAL):
+        self.tab.send_task(task.task_code.__name__, task.args, priority)
+
+    def clear_pending_tasks(self):
+        self.tab.send("clear_pending_tasks")
+
+    def is_idle(self):
+        return self.tab.query_idle()
+
+    def set_needs_quit(self):
+        self.tab.quit()
+
+class TabProcess:
+    def __init__(self, browser, tab_height):
+        self.browser = browser
+        self.url = None
+        self.background = False
+        self.inactive_since = None
+        self.discarded = False
+        self.task_runner = TabProcessTaskRunner(self)
+        self.timers = self.task_runner
+
+        self.remote_nodes = weakref.WeakValueDictionary()
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.idle_replies = {}
+        self.next_query = 0
+        self.closed = False
+        self.crashed = False
+        self.lost_history = False
+
+        self.tab_height = tab_height
+        self.start_process()
+
+    def start_process(self):
+        context = multiprocessing.get_context("spawn")
+        self.buffer = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=COMMIT_BUFFER_SIZE)
+        self.buffer_free = context.Semaphore(1)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_tab_process,
+            args=(child_conn, self.buffer.name, self.buffer_free,
+                  self.tab_height, self.browser.dark_mode),
+            name="Tab process",
+            daemon=True,
+        )
+        self.process.start()
+        self.receiver = threading.Thread(
+            target=self.receive,
+            args=(self.conn,),
+            name="Tab process receiver",
+            daemon=True,
+        )
+        self.receiver.start()
+
+    def send(self, *message):
+        self.send_lock.acquire(blocking=True)
+        if not self.closed:
+            try:
+                self.conn.send(message)
+            except OSError:
+                # The process died; receive() sees the EOF and marks
+                # the tab crashed.
+                pass
+        self.send_lock.release()
+
+    def crash(self, conn):
+        self.browser.lock.acquire(blocking=True)
+        self.send_lock.acquire(blocking=True)
+        crashed = not self.closed and conn == self.conn
+        if crashed:
+            self.closed = True
+            self.crashed = True
+        self.send_lock.release()
+        if crashed:
+            print("Tab process for", self.url, "crashed")
+            self.condition.acquire(blocking=True)
+            self.condition.notify_all()
+            self.condition.release()
+            self.browser.tab_crashed(self)
+        self.browser.lock.release()
+
+    def restart(self):
+        self.process.join(0)
+        self.buffer.close()
+        self.buffer.unlink()
+        self.start_process()
+        self.send_lock.acquire(blocking=True)
+        self.closed = False
+        self.crashed = False
+        self.lost_history = True
+        self.send_lock.release()
+        self.send("set_background", self.background)
+
+    def send_task(self, name, args, priority):
+        if self.crashed:
+            self.restart()
+        if self.lost_history and name in ["load", "restore"]:
+            self.lost_history = False
+            # The new process has no history to restore from, so
+            # reload the last committed page instead.
+            if name == "restore":
+                if self.url == None: return
+                (name, args) = ("load", (self.url, None))
+        if name == "finish_animations":
+            args = ([(node.node_id, property, animation.remote_id)
+                     for (node, property, animation) in args[0]],)
+        state = {
+            "accessibility_is_on": self.browser.accessibility_is_on,
+            "next_frame": self.browser.frame_clock.next_frame,
+        }
+        self.send("task", name, args, priority, state)
+
+    def set_background(self, background):
+        self.background = background
+        self.inactive_since = time.time() if background else None
+        self.send("set_background", background)
+
+    def remote_node(self, node_id):
+        if node_id == None: return None
+        node = self.remote_nodes.get(node_id)
+        if not node:
+            node = RemoteNode(node_id)
+            self.remote_nodes[node_id] = node
+        return node
+
+    def decode_commit(self, payload):
+        (url, scroll, height, display_list, composited_updates,
+            accessibility_tree, focus, animations, display_list_patch,
+            damage, display_list_version) = pickle.loads(payload)
+        if display_list != None:
+            display_list = display_list.decode(self.remote_node)
+        if display_list_patch != None:
+            display_list_patch = [
+                (path, item.decode(self.remote_node)[0])
+                for (path, item) in display_list_patch]
+            damage = [skia.Rect.MakeLTRB(*rect) for rect in damage]
+        if composited_updates != None:
+            updates = {}
+            for (node_id, opacity, blend_mode) in composited_updates:
+                node = self.remote_node(node_id)
+                updates[node] = Blend(opacity, blend_mode, node, [])
+            composited_updates = updates
+        if accessibility_tree:
+            accessibility_tree = decode_accessibility_tree(
+                accessibility_tree, self.remote_node)
+        new_animations = []
+        for (node_id, property, animation_id, animation) in animations:
+            animation.remote_id = animation_id
+            new_animations.append(
+                (self.remote_node(node_id), property, animation))
+        self.url = url
+        return CommitData(url, scroll, height, display_list,
+            composited_updates, accessibility_tree,
+            self.remote_node(focus), new_animations,
+            display_list_patch, damage, display_list_version)
+
+    def receive(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                self.crash(conn)
+                return
+            if message[0] == "commit_shared":
+                payload = bytes(self.buffer.buf[:message[1]])
+                self.buffer_free.release()
+                self.browser.commit(self, self.decode_commit(payload))
+            elif message[0] == "commit_inline":
+                self.browser.commit(self, self.decode_commit(message[1]))
+            elif message[0] == "needs_animation_frame":
+                self.browser.set_needs_animation_frame(self)
+            elif message[0] == "accessibility":
+                tree = decode_accessibility_tree(
+                    pickle.loads(message[1]), self.remote_node)
+                self.browser.commit_accessibility(self, tree)
+            elif message[0] == "focus_addressbar":
+                self.browser.focus_addressbar()
+            elif message[0] == "idle":
+                self.condition.acquire(blocking=True)
+                self.idle_replies[message[1]] = message[2]
+                self.condition.notify_all()
+                self.condition.release()
+
+    def query_idle(self):
+        self.condition.acquire(blocking=True)
+        query = self.next_query
+        self.next_query += 1
+        self.condition.release()
+        self.send("is_idle", query)
+        self.condition.acquire(blocking=True)
+        while query not in self.idle_replies and not self.closed:
+            self.condition.wait()
+        idle = self.idle_replies.pop(query, self.closed)
+        self.condition.release()
+        return idle
+
+    def quit(self):
+        if self.closed: return
+        self.send("quit")
+        self.send_lock.acquire(blocking=True)
+        self.closed = True
+        self.send_lock.release()
+        self.condition.acquire(blocking=True)
+        self.condition.notify_all()
+        self.condition.release()
+        self.process.join(TAB_PROCESS_QUIT_TIMEOUT_SEC)
+        self.buffer.close()
+        self.buffer.unlink()
+
+def forward_to_tab_process(name):
+    def forward(self, *args):
+        self.send_task(name, args, TASK_PRIORITY_NORMAL)
+    forward.__name__ = name
+    return forward
+
+for name in TAB_PROCESS_TASKS:
+    setattr(TabProcess, name, forward_to_tab_process(name))
 
 def local_to_absolute(display_item, rect):
     while display_item.parent:
@@ -2071,64 +3904,365 @@ def absolute_to_local(display_item, rect):
 
 SHOW_COMPOSITED_LAYER_BORDERS = True
 
-class CompositedLayer:
-    def __init__(self, skia_context, display_item):
+TILE_SIZE = 256
+TILE_PREFETCH_MARGIN = HEIGHT // 2
+TILE_EVICTION_MARGIN = 2 * HEIGHT
+
+SURFACE_BUCKET_SIZE = 64
+GPU_MEMORY_BUDGET = 256 * 1024 * 1024
+
+def make_surface(skia_context, width, height):
+    if skia_context:
+        return skia.Surface.MakeRenderTarget(
+            skia_context, skia.Budgeted.kNo,
+            skia.ImageInfo.MakeN32Premul(width, height))
+    else:
+        return skia.Surface.MakeRasterN32Premul(width, height)
+
+def surface_bytes(surface):
+    return surface.width() * surface.height() * 4
+
+class SurfacePool:
+    def __init__(self, skia_context, budget=GPU_MEMORY_BUDGET):
         self.skia_context = skia_context
-        self.surface = None
-        self.display_items = [display_item]
+        self.budget = budget
+        self.free = {}
+        self.free_order = []
+        self.memory = 0
+        self.allocated_count = 0
+        self.reused_count = 0
+        self.destroyed_count = 0
+
+    def bucket(self, width, height):
+        return (
+            math.ceil(width / SURFACE_BUCKET_SIZE) * SURFACE_BUCKET_SIZE,
+            math.ceil(height / SURFACE_BUCKET_SIZE) * SURFACE_BUCKET_SIZE)
+
+    def acquire(self, width, height):
+        key = self.bucket(width, height)
+        if self.free.get(key):
+            surface = self.free[key].pop()
+            self.free_order.remove(surface)
+            self.reused_count += 1
+            return surface
+        (bucket_width, bucket_height) = key
+        surface = make_surface(
+            self.skia_context, bucket_width, bucket_height)
+        assert surface
+        self.memory += surface_bytes(surface)
+        self.allocated_count += 1
+        return surface
+
+    def release(self, surface):
+        key = (surface.width(), surface.height())
+        self.free.setdefault(key, []).append(surface)
+        self.free_order.append(surface)
+
+    def over_budget(self):
+        return self.memory > self.budget
+
+    def destroy_oldest_free(self):
+        if not self.free_order: return False
+        surface = self.free_order.pop(0)
+        self.free[(surface.width(), surface.height())].remove(surface)
+        self.memory -= surface_bytes(surface)
+        self.destroyed_count += 1
+        return True
+
+    def stats(self):
+        return {
+            "allocated": self.allocated_count,
+            "reused": self.reused_count,
+            "destroyed": self.destroyed_count,
+            "free": len(self.free_order),
+            "memory": self.memory,
+        }
+
+class TileCache:
+    def __init__(self, surface_pool):
+        self.surface_pool = surface_pool
+        self.tiles = {}
+        self.memory = 0
+        self.rastered_count = 0
+        self.rastered_pixels = 0
+        self.evicted_count = 0
+
+    def touch(self, layer, key):
+        surface = self.tiles.pop((layer, key))
+        self.tiles[(layer, key)] = surface
+
+    def allocate(self, layer, key, width, height):
+        surface = self.surface_pool.acquire(width, height)
+        self.tiles[(layer, key)] = surface
+        self.memory += surface_bytes(surface)
+        self.rastered_count += 1
+        layer.tiles[key] = surface
+        self.enforce_budget()
+        return surface
+
+    def evict(self, layer, key):
+        surface = self.tiles.pop((layer, key))
+        self.memory -= surface_bytes(surface)
+        self.evicted_count += 1
+        del layer.tiles[key]
+        layer.dirty.pop(key, None)
+        self.surface_pool.release(surface)
+
+    def release_layer(self, layer):
+        for key in list(layer.tiles):
+            self.evict(layer, key)
+
+    def transfer(self, old_layer, new_layer):
+        for key, surface in old_layer.tiles.items():
+            del self.tiles[(old_layer, key)]
+            self.tiles[(new_layer, key)] = surface
+        new_layer.tiles = old_layer.tiles
+        new_layer.dirty = old_layer.dirty
+        old_layer.tiles = {}
+        old_layer.dirty = {}
+
+    def enforce_budget(self):
+        while self.surface_pool.over_budget():
+            if self.surface_pool.destroy_oldest_free():
+                continue
+            if len(self.tiles) <= 1:
+                break
+            (layer, key) = next(iter(self.tiles))
+            self.evict(layer, key)
+
+    def stats(self):
+        return {
+            "resident": len(self.tiles),
+            "rastered": self.rastered_count,
+            "pixels": self.rastered_pixels,
+            "evicted": self.evicted_count,
+            "memory": self.memory,
+        }
+
+def tile_range(rect, bounds):
+    left = max(0, math.floor((rect.left() - bounds.left()) / TILE_SIZE))
+    top = max(0, math.floor((rect.top() - bounds.top()) / TILE_SIZE))
+    right = math.ceil((rect.right() - bounds.left()) / TILE_SIZE)
+    bottom = math.ceil((rect.bottom() - bounds.top()) / TILE_SIZE)
+    return left, top, right, bottom
+
+class CompositedLayer:
+    def __init__(self, tile_cache, display_item, absolute_rect):
+        self.tile_cache = tile_cache
+        self.tiles = {}
+        self.dirty = {}
+        self.display_items = []
+        self.absolute_rect = skia.Rect.MakeEmpty()
+        self.composited_rect = None
+        self.add(display_item, absolute_rect)
 
     def composited_bounds(self):
-        rect = skia.Rect.MakeEmpty()
-        for item in self.display_items:
-            rect.join(absolute_to_local(
-                item, local_to_absolute(item, item.rect)))
-        rect.outset(1, 1)
-        return rect
+        if not self.composited_rect:
+            rect = skia.Rect.MakeEmpty()
+            for item in self.display_items:
+                rect.join(absolute_to_local(
+                    item, local_to_absolute(item, item.rect)))
+            rect.outset(1, 1)
+            self.composited_rect = rect
+        return self.composited_rect
 
     def absolute_bounds(self):
-        rect = skia.Rect.MakeEmpty()
-        for item in self.display_items:
-            rect.join(local_to_absolute(item, item.rect))
-        return rect
+        return self.absolute_rect
 
     def can_merge(self, display_item):
         return display_item.parent == \
             self.display_items[0].parent
 
-    def add(self, display_item):
+    def add(self, display_item, absolute_rect):
         self.display_items.append(display_item)
+        self.absolute_rect.join(absolute_rect)
+        self.composited_rect = None
 
-    def raster(self):
+    def invalidate(self, damage):
+        bounds = self.composited_bounds()
+        for rect in damage:
+            local = absolute_to_local(self.display_items[0], rect) \
+                .makeOutset(INK_OVERFLOW, INK_OVERFLOW)
+            if not skia.Rect.Intersects(local, bounds): continue
+            (left, top, right, bottom) = tile_range(local, bounds)
+            for (col, row) in self.tiles:
+                if left <= col < right and top <= row < bottom:
+                    dirty = self.dirty.setdefault(
+                        (col, row), skia.Rect.MakeEmpty())
+                    dirty.join(local)
+
+    def raster(self, viewport):
         bounds = self.composited_bounds()
         if bounds.isEmpty(): return
         irect = bounds.roundOut()
 
-        if not self.surface:
-            self.surface = skia.Surface.MakeRenderTarget(
-                self.skia_context, skia.Budgeted.kNo,
-                skia.ImageInfo.MakeN32Premul(
-                    irect.width(), irect.height()))
-            assert self.surface
-
-        canvas = self.surface.getCanvas()
-
-        canvas.clear(skia.ColorTRANSPARENT)
+        local_viewport = absolute_to_local(
+            self.display_items[0], viewport)
+        interest = local_viewport.makeOutset(0, TILE_PREFETCH_MARGIN)
+        keep = local_viewport.makeOutset(0, TILE_EVICTION_MARGIN)
+
+        (left, top, right, bottom) = tile_range(keep, bounds)
+        for (col, row) in list(self.tiles):
+            if not (left <= col < right and top <= row < bottom):
+                self.tile_cache.evict(self, (col, row))
+
+        (left, top, right, bottom) = tile_range(interest, bounds)
+        right = min(right, math.ceil(irect.width() / TILE_SIZE))
+        bottom = min(bottom, math.ceil(irect.height() / TILE_SIZE))
+        for row in range(top, bottom):
+            for col in range(left, right):
+                if (col, row) in self.dirty:
+                    self.raster_dirty_region(bounds, irect, col, row)
+                if (col, row) in self.tiles:
+                    self.tile_cache.touch(self, (col, row))
+                else:
+                    self.raster_tile(bounds, irect, col, row)
+
+    def tile_size(self, irect, col, row):
+        width = min(TILE_SIZE, irect.width() - col * TILE_SIZE)
+        height = min(TILE_SIZE, irect.height() - row * TILE_SIZE)
+        return (width, height)
+
+    def raster_tile(self, bounds, irect, col, row):
+        (width, height) = self.tile_size(irect, col, row)
+        surface = self.tile_cache.allocate(
+            self, (col, row), width, height)
+        surface.getCanvas().clear(skia.ColorTRANSPARENT)
+        self.paint_tile(surface, bounds, irect, col, row,
+            skia.Rect.MakeWH(width, height))
+
+    def raster_dirty_region(self, bounds, irect, col, row):
+        dirty = self.dirty.pop((col, row)).makeOffset(
+            -bounds.left() - col * TILE_SIZE,
+            -bounds.top() - row * TILE_SIZE)
+        clip = skia.Rect.Make(dirty.roundOut())
+        (width, height) = self.tile_size(irect, col, row)
+        if not clip.intersect(skia.Rect.MakeWH(width, height)): return
+        self.paint_tile(self.tiles[(col, row)], bounds, irect,
+            col, row, clip)
+
+    def paint_tile(self, surface, bounds, irect, col, row, clip):
+        canvas = surface.getCanvas()
         canvas.save()
-        canvas.translate(-bounds.left(), -bounds.top())
-        for item in self.display_items:
-            item.execute(canvas)
-        canvas.restore()
+        canvas.clipRect(clip)
+        canvas.clear(skia.ColorTRANSPARENT)
+        canvas.translate(
+            -bounds.left() - col * TILE_SIZE,
+            -bounds.top() - row * TILE_SIZE)
+        execute_visible(self.display_items, canvas)
 
         if SHOW_COMPOSITED_LAYER_BORDERS:
             border_rect = skia.Rect.MakeXYWH(
-                1, 1, irect.width() - 2, irect.height() - 2)
+                bounds.left() + 1, bounds.top() + 1,
+                irect.width() - 2, irect.height() - 2)
             DrawOutline(border_rect, "red", 1).execute(canvas)
+        canvas.restore()
+        self.tile_cache.rastered_pixels += \
+            int(clip.width() * clip.height())
 
 def add_parent_pointers(nodes, parent=None):
     for node in nodes:
         node.parent = parent
         add_parent_pointers(node.children, node)
 
+OVERLAP_BAND_HEIGHT = 1024
+OVERLAP_SCAN_LAYERS = 256
+
+class OverlapIndex:
+    def __init__(self, layers):
+        self.layers = layers
+        self.bands = {}
+        self.ranges = {}
+        self.stale = set(range(len(layers)))
+
+    def band_range(self, rect):
+        return (
+            math.floor(rect.top() / OVERLAP_BAND_HEIGHT),
+            math.floor(rect.bottom() / OVERLAP_BAND_HEIGHT))
+
+    def invalidate(self, index):
+        self.stale.add(index)
+
+    def sync(self):
+        for index in self.stale:
+            self.update(index, self.layers[index].absolute_bounds())
+        self.stale.clear()
+
+    def update(self, index, rect):
+        if rect.isEmpty(): return
+        (top, bottom) = self.band_range(rect)
+        # Layers only grow, so just the bands outside the old range
+        # need the index added.
+        (old_top, old_bottom) = self.ranges.get(index, (top, top - 1))
+        self.ranges[index] = (min(top, old_top), max(bottom, old_bottom))
+        for band in range(top, bottom + 1):
+            if old_top <= band <= old_bottom: continue
+            self.bands.setdefault(band, []).append(index)
+
+    def last_overlap(self, rect, above):
+        if rect.isEmpty(): return -1
+        self.sync()
+        (top, bottom) = self.band_range(rect)
+        candidates = set()
+        for band in range(top, bottom + 1):
+            for index in self.bands.get(band, []):
+                if index > above:
+                    candidates.add(index)
+        for index in sorted(candidates, reverse=True):
+            if skia.Rect.Intersects(
+                self.layers[index].absolute_bounds(), rect):
+                return index
+        return -1
+
+def assign_composited_layers(display_list, tile_cache):
+    layers = []
+    add_parent_pointers(display_list)
+    all_commands = []
+    for cmd in display_list:
+        all_commands = tree_to_list(cmd, all_commands)
+    non_composited_commands = [cmd
+        for cmd in all_commands
+        if isinstance(cmd, PaintCommand) or \
+            not cmd.needs_compositing
+        if not cmd.parent or cmd.parent.needs_compositing
+    ]
+    overlap_index = None
+    last_layer_for_parent = {}
+    for cmd in non_composited_commands:
+        rect = local_to_absolute(cmd, cmd.rect)
+        merge_index = last_layer_for_parent.get(cmd.parent, -1)
+        last_overlap = -1
+        top = len(layers) - 1
+        if merge_index < top:
+            # Commands nearly always overlap a layer near the top, so
+            # scan down from there and only fall back to the index
+            # when many layers lie above the merge target.
+            stop = max(merge_index, top - OVERLAP_SCAN_LAYERS)
+            for index in range(top, stop, -1):
+                if skia.Rect.Intersects(
+                    layers[index].absolute_bounds(), rect):
+                    last_overlap = index
+                    break
+            if last_overlap < 0 and stop > merge_index:
+                if overlap_index == None:
+                    overlap_index = OverlapIndex(layers)
+                last_overlap = overlap_index.last_overlap(
+                    rect, merge_index)
+        if merge_index >= 0 and merge_index >= last_overlap:
+            index = merge_index
+            layers[index].add(cmd, rect)
+        else:
+            index = len(layers)
+            layers.append(CompositedLayer(tile_cache, cmd, rect))
+            last_layer_for_parent[cmd.parent] = index
+        if overlap_index != None:
+            overlap_index.invalidate(index)
+    return layers
+
+TAB_DISCARD_AFTER_SEC = 300
+MAX_LIVE_TABS = 4
+TAB_CHECK_INTERVAL_SEC = 1
+
 SPEECH_FILE = "/tmp/speech-fragment.mp3"
 
 def speak_text(text):
@@ -2140,39 +4274,52 @@ def speak_text(text):
     os.remove(SPEECH_FILE)
 
 class Browser:
-    def __init__(self):
+    def __init__(self, headless=False, process_per_tab=False):
         self.chrome = Chrome(self)
+        self.headless = headless
+        self.process_per_tab = process_per_tab
 
-        self.sdl_window = sdl2.SDL_CreateWindow(b"Browser",
-            sdl2.SDL_WINDOWPOS_CENTERED, sdl2.SDL_WINDOWPOS_CENTERED,
-            WIDTH, HEIGHT, sdl2.SDL_WINDOW_SHOWN | sdl2.SDL_WINDOW_OPENGL)
-        self.gl_context = sdl2.SDL_GL_CreateContext(
-            self.sdl_window)
-        print(("OpenGL initialized: vendor={}," + \
-            "renderer={}").format(
-            OpenGL.GL.glGetString(OpenGL.GL.GL_VENDOR),
-            OpenGL.GL.glGetString(OpenGL.GL.GL_RENDERER)))
-
-        self.skia_context = skia.GrDirectContext.MakeGL()
-
-        self.root_surface = skia.Surface.MakeFromBackendRenderTarget(
-            self.skia_context,
-            skia.GrBackendRenderTarget(
-                WIDTH, HEIGHT, 0, 0,
-                skia.GrGLFramebufferInfo(
-                    0, OpenGL.GL.GL_RGBA8)),
-                skia.kBottomLeft_GrSurfaceOrigin,
-                skia.kRGBA_8888_ColorType,
-                skia.ColorSpace.MakeSRGB())
+        if headless:
+            self.skia_context = None
+            self.root_surface = skia.Surface.MakeRasterN32Premul(
+                WIDTH, HEIGHT)
+        else:
+            self.sdl_window = sdl2.SDL_CreateWindow(b"Browser",
+                sdl2.SDL_WINDOWPOS_CENTERED, sdl2.SDL_WINDOWPOS_CENTERED,
+                WIDTH, HEIGHT,
+                sdl2.SDL_WINDOW_SHOWN | sdl2.SDL_WINDOW_OPENGL)
+            self.gl_context = sdl2.SDL_GL_CreateContext(
+                self.sdl_window)
+            print(("OpenGL initialized: vendor={}," + \
+                "renderer={}").format(
+                OpenGL.GL.glGetString(OpenGL.GL.GL_VENDOR),
+                OpenGL.GL.glGetString(OpenGL.GL.GL_RENDERER)))
+
+            self.skia_context = skia.GrDirectContext.MakeGL()
+
+            self.root_surface = \
+                skia.Surface.MakeFromBackendRenderTarget(
+                self.skia_context,
+                skia.GrBackendRenderTarget(
+                    WIDTH, HEIGHT, 0, 0,
+                    skia.GrGLFramebufferInfo(
+                        0, OpenGL.GL.GL_RGBA8)),
+                    skia.kBottomLeft_GrSurfaceOrigin,
+                    skia.kRGBA_8888_ColorType,
+                    skia.ColorSpace.MakeSRGB())
         assert self.root_surface is not None
 
-        self.chrome_surface = skia.Surface.MakeRenderTarget(
-                self.skia_context, skia.Budgeted.kNo,
-                skia.ImageInfo.MakeN32Premul(
-                    WIDTH, math.ceil(self.chrome.bottom)))
+        self.chrome_surface = make_surface(
+            self.skia_context, WIDTH, math.ceil(self.chrome.bottom))
         assert self.chrome_surface is not None
 
         self.tab_surface = None
+        self.surface_pool = SurfacePool(self.skia_context)
+        self.fetcher = FetchExecutor()
+        self.tile_cache = TileCache(self.surface_pool)
+        self.interpreter_pool = InterpreterPool()
+        self.script_cache = ScriptCache()
+        self.interpreter_pool.fill()
 
         self.tabs = []
         self.active_tab = None
@@ -2182,11 +4329,31 @@ class Browser:
         self.active_tab_scroll = 0
         self.active_tab_height = 0
         self.active_tab_display_list = None
+        self.active_tab_display_list_version = None
+        self.damage = None
+        self.draw_damage = None
+        self.drawn_scroll = None
+        self.drawn_dark_mode = None
+        self.chrome_key = None
+        self.chrome_damaged = True
 
         self.measure = MeasureTime()
         threading.current_thread().name = "Browser thread"
 
-        if sdl2.SDL_BYTEORDER == sdl2.SDL_BIG_ENDIAN:
+        self.frame_clock = FrameClock()
+        self.frame_stats = FrameStats()
+        self.frame_in_flight = False
+        self.frame_start = None
+        self.frame_input_time = None
+        self.pending_input_time = None
+        self.commit_time = None
+        self.commit_frame_start = None
+        if headless:
+            self.wakeup = threading.Event()
+        else:
+            self.wakeup_event_type = sdl2.SDL_RegisterEvents(1)
+
+        if not headless and sdl2.SDL_BYTEORDER == sdl2.SDL_BIG_ENDIAN:
             self.RED_MASK = 0xff000000
             self.GREEN_MASK = 0x00ff0000
             self.BLUE_MASK = 0x0000ff00
@@ -2197,8 +4364,6 @@ class Browser:
             self.BLUE_MASK = 0x00ff0000
             self.ALPHA_MASK = 0xff000000
 
-        self.animation_timer = None
-
         self.needs_animation_frame = False
         self.needs_composite = False
         self.needs_raster = False
@@ -2216,6 +4381,11 @@ class Browser:
 
         self.composited_layers = []
         self.draw_list = []
+        self.compositor_animations = {}
+
+        self.tab_discards = 0
+        self.tab_restores = 0
+        self.last_tab_check = 0
 
         self.dark_mode = False
 
@@ -2225,49 +4395,139 @@ class Browser:
             self.active_tab_url = data.url
             if data.scroll != None:
                 self.active_tab_scroll = data.scroll
+                self.set_needs_raster()
             self.active_tab_height = data.height
             if data.display_list:
                 self.active_tab_display_list = data.display_list
-            self.animation_timer = None
+                self.active_tab_display_list_version = \
+                    data.display_list_version
+                self.damage = None
+            elif data.display_list_patch != None and \
+                self.active_tab_display_list_version == \
+                    data.display_list_version - 1:
+                patch_display_list(self.active_tab_display_list,
+                    data.display_list_patch)
+                self.active_tab_display_list_version = \
+                    data.display_list_version
+                if self.damage != None:
+                    self.damage.extend(data.damage)
+            self.frame_in_flight = False
+            now = time.perf_counter()
+            if self.frame_input_time != None:
+                self.frame_stats.record_input(now - self.frame_input_time)
+                self.frame_input_time = None
+            self.commit_time = now
+            self.commit_frame_start = self.frame_start
             self.composited_updates = data.composited_updates
-            self.accessibility_tree = data.accessibility_tree
+            for (node, property, animation) in data.animations:
+                self.compositor_animations.setdefault(
+                    node, {})[property] = animation
+            if data.accessibility_tree:
+                self.accessibility_tree = data.accessibility_tree
             self.tab_focus = data.focus
             if self.composited_updates == None:
                 self.composited_updates = {}
                 self.set_needs_composite()
             else:
+                if self.composited_updates:
+                    self.draw_damage = None
                 self.set_needs_draw()
         self.lock.release()
+        self.wake()
 
-    def composite(self):
-        self.composited_layers = []
-        add_parent_pointers(self.active_tab_display_list)
-        all_commands = []
-        for cmd in self.active_tab_display_list:
-            all_commands = tree_to_list(cmd, all_commands)
-        non_composited_commands = [cmd
-            for cmd in all_commands
-            if isinstance(cmd, PaintCommand) or \
-                not cmd.needs_compositing
-            if not cmd.parent or cmd.parent.needs_compositing
-        ]
-        for cmd in non_composited_commands:
-            for layer in reversed(self.composited_layers):
-                if layer.can_merge(cmd):
-                    layer.add(cmd)
-                    break
-                elif skia.Rect.Intersects(
-                    layer.absolute_bounds(),
-                    local_to_absolute(cmd, cmd.rect)):
-                    layer = CompositedLayer(self.skia_context, cmd)
-                    self.composited_layers.append(layer)
-                    break
-            else:
-                layer = CompositedLayer(self.skia_context, cmd)
-                self.composited_layers.append(layer)
+    def wake(self):
+        if self.headless:
+            self.wakeup.set()
+        else:
+            event = sdl2.SDL_Event()
+            event.type = self.wakeup_event_type
+            sdl2.SDL_PushEvent(ctypes.byref(event))
+
+    def wait_timeout(self):
+        self.lock.acquire(blocking=True)
+        needs_frame = self.needs_composite or \
+            self.needs_raster or \
+            self.needs_draw or \
+            bool(self.compositor_animations) or \
+            (self.needs_animation_frame and not self.frame_in_flight)
+        self.lock.release()
+        if needs_frame:
+            return self.frame_clock.time_until_frame()
+        return MAX_IDLE_WAIT_SEC
+
+    def commit_accessibility(self, tab, tree):
+        self.lock.acquire(blocking=True)
+        if tab == self.active_tab:
+            self.accessibility_tree = tree
+        self.lock.release()
 
-    def get_latest(self, effect):
+    def composite(self):
+        old_layers = {}
+        for layer in self.composited_layers:
+            old_layers[tuple(layer.display_items)] = layer
+        self.composited_layers = assign_composited_layers(
+            self.active_tab_display_list, self.tile_cache)
+        if self.damage != None:
+            for layer in self.composited_layers:
+                old_layer = old_layers.pop(
+                    tuple(layer.display_items), None)
+                if not old_layer or old_layer.composited_bounds() != \
+                    layer.composited_bounds():
+                    continue
+                self.tile_cache.transfer(old_layer, layer)
+                layer.invalidate(self.damage)
+        for layer in old_layers.values():
+            self.tile_cache.release_layer(layer)
+
+        if self.damage != None:
+            area = damage_area(self.damage)
+        else:
+            bounds = skia.Rect.MakeEmpty()
+            for item in self.active_tab_display_list:
+                bounds.join(item.rect)
+            area = damage_area([bounds])
+        self.frame_stats.record_damage(area)
+        self.measure.counter("Damage", {"area": area})
+        if self.damage != None and self.draw_damage != None:
+            self.draw_damage.extend(self.damage)
+        else:
+            self.draw_damage = None
+        self.damage = []
+
+    def run_compositor_animations(self):
+        if not self.compositor_animations: return
+
+        finished = []
+        for node, animations in list(self.compositor_animations.items()):
+            for property, animation in list(animations.items()):
+                if animation.animate() == None:
+                    del animations[property]
+                    finished.append((node, property, animation))
+            if not animations:
+                del self.compositor_animations[node]
+        self.draw_damage = None
+        self.set_needs_draw()
+
+        if finished:
+            task = Task(self.active_tab.finish_animations, finished)
+            self.active_tab.task_runner.schedule_task(
+                task, TASK_PRIORITY_RENDERING)
+
+    def get_latest(self, effect, latest_effects):
+        if effect in latest_effects:
+            return latest_effects[effect]
         node = effect.node
+        animations = self.compositor_animations.get(node, {})
+        if isinstance(effect, Blend) and "opacity" in animations:
+            opacity = float(animations["opacity"].value)
+            latest_effects[effect] = \
+                Blend(opacity, effect.blend_mode, node, [])
+            return latest_effects[effect]
+        if isinstance(effect, Transform) and "transform" in animations:
+            translation = parse_transform(animations["transform"].value)
+            latest_effects[effect] = \
+                Transform(translation, effect.self_rect, node, [])
+            return latest_effects[effect]
         if node not in self.composited_updates:
             return effect
         if not isinstance(effect, Blend):
@@ -2276,6 +4536,7 @@ class Browser:
 
     def paint_draw_list(self):
         new_effects = {}
+        latest_effects = {}
         self.draw_list = []
         for composited_layer in self.composited_layers:
             current_effect = \
@@ -2283,9 +4544,9 @@ class Browser:
             if not composited_layer.display_items: continue
             parent = composited_layer.display_items[0].parent
             while parent:
-                new_parent = self.get_latest(parent)
+                new_parent = self.get_latest(parent, latest_effects)
                 if new_parent in new_effects:
-                    new_effects[parent].children.append(
+                    new_effects[new_parent].children.append(
                         current_effect)
                     break
                 else:
@@ -2295,6 +4556,7 @@ class Browser:
                     parent = parent.parent
             if not parent:
                 self.draw_list.append(current_effect)
+        update_effect_rects(self.draw_list)
 
         if self.pending_hover:
             (x, y) = self.pending_hover
@@ -2321,9 +4583,12 @@ class Browser:
 
     def set_needs_animation_frame(self, tab):
         self.lock.acquire(blocking=True)
-        if tab == self.active_tab:
+        is_active = tab == self.active_tab
+        if is_active:
             self.needs_animation_frame = True
         self.lock.release()
+        if is_active:
+            self.wake()
 
     def set_needs_raster(self):
         self.needs_raster = True
@@ -2358,19 +4623,23 @@ class Browser:
             self.active_tab_scroll + SCROLL_STEP)
         self.set_needs_raster()
         self.needs_animation_frame = True
+        self.note_input()
         self.lock.release()
 
     def handle_tab(self):
         self.focus = "content"
         self.chrome.blur()
+        self.note_input()
         task = Task(self.active_tab.advance_tab)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_INPUT)
 
     def focus_addressbar(self):
         self.lock.acquire(blocking=True)
         self.chrome.focus_addressbar()
         self.set_needs_raster()
         self.lock.release()
+        self.wake()
 
     def cycle_tabs(self):
         self.lock.acquire(blocking=True)
@@ -2389,20 +4658,85 @@ class Browser:
         self.active_tab_scroll = 0
         self.active_tab_url = None
         self.display_list = []
+        self.active_tab_display_list_version = None
+        self.damage = None
+        self.draw_damage = None
+        for layer in self.composited_layers:
+            self.tile_cache.release_layer(layer)
         self.composited_layers = []
         self.composited_updates = {}
+        self.compositor_animations = {}
         self.accessibility_tree = None
 
     def set_active_tab(self, tab):
+        if self.active_tab and self.compositor_animations:
+            finished = [(node, property, animation)
+                for node, animations in self.compositor_animations.items()
+                for property, animation in animations.items()]
+            task = Task(self.active_tab.finish_animations, finished)
+            self.active_tab.task_runner.schedule_task(
+                task, TASK_PRIORITY_RENDERING)
+        if self.active_tab:
+            self.active_tab.set_background(True)
         self.active_tab = tab
+        tab.set_background(False)
+        if tab.discarded:
+            tab.discarded = False
+            self.tab_restores += 1
+            tab.task_runner.schedule_task(
+                Task(tab.restore), TASK_PRIORITY_RENDERING)
         task = Task(self.active_tab.set_dark_mode, self.dark_mode)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_RENDERING)
         task = Task(self.active_tab.set_needs_paint)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_RENDERING)
 
         self.clear_data()
         self.needs_animation_frame = True
-        self.animation_timer = None
+        self.frame_in_flight = False
+        self.frame_input_time = None
+        self.pending_input_time = None
+        self.commit_time = None
+
+    def discard_tab(self, tab):
+        tab.discarded = True
+        self.tab_discards += 1
+        tab.task_runner.clear_pending_tasks()
+        tab.task_runner.schedule_task(
+            Task(tab.discard), TASK_PRIORITY_RENDERING)
+
+    def discard_background_tabs(self, max_live_tabs):
+        now = time.time()
+        candidates = sorted([
+            tab for tab in self.tabs
+            if tab != self.active_tab and not tab.discarded and tab.url
+            and now - tab.inactive_since >= TAB_DISCARD_AFTER_SEC
+        ], key=lambda tab: tab.inactive_since)
+        live_tabs = len([tab for tab in self.tabs if not tab.discarded])
+        for tab in candidates:
+            if live_tabs <= max_live_tabs: break
+            self.discard_tab(tab)
+            live_tabs -= 1
+
+    def tab_crashed(self, tab):
+        tab.discarded = True
+        if tab == self.active_tab:
+            self.set_active_tab(tab)
+
+    def handle_memory_pressure(self):
+        self.lock.acquire(blocking=True)
+        self.discard_background_tabs(0)
+        self.lock.release()
+
+    def tab_stats(self):
+        return {
+            "throttled": len([tab for tab in self.tabs
+                if tab.background and not tab.discarded]),
+            "discarded": len([tab for tab in self.tabs if tab.discarded]),
+            "discards": self.tab_discards,
+            "restores": self.tab_restores,
+        }
 
     def handle_click(self, e):
         self.lock.acquire(blocking=True)
@@ -2417,8 +4751,10 @@ class Browser:
                 self.set_needs_raster()
             self.chrome.blur()
             tab_y = e.y - self.chrome.bottom
+            self.note_input()
             task = Task(self.active_tab.click, e.x, tab_y)
-            self.active_tab.task_runner.schedule_task(task)
+            self.active_tab.task_runner.schedule_task(
+                task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def handle_key(self, char):
@@ -2428,12 +4764,15 @@ class Browser:
         if self.chrome.keypress(char):
             self.set_needs_raster()
         elif self.focus == "content":
+            self.note_input()
             task = Task(self.active_tab.keypress, char)
-            self.active_tab.task_runner.schedule_task(task)
+            self.active_tab.task_runner.schedule_task(
+                task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def schedule_load(self, url, body=None):
         self.active_tab.task_runner.clear_pending_tasks()
+        self.frame_in_flight = False
         task = Task(self.active_tab.load, url, body)
         self.active_tab.task_runner.schedule_task(task)
 
@@ -2442,27 +4781,32 @@ class Browser:
         if self.chrome.enter():
             self.set_needs_raster()
         elif self.focus == "content":
+            self.note_input()
             task = Task(self.active_tab.enter)
-            self.active_tab.task_runner.schedule_task(task)
+            self.active_tab.task_runner.schedule_task(
+                task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def increment_zoom(self, increment):
         self.lock.acquire(blocking=True)
         task = Task(self.active_tab.zoom_by, increment)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def toggle_dark_mode(self):
         self.lock.acquire(blocking=True)
         self.dark_mode = not self.dark_mode
         task = Task(self.active_tab.set_dark_mode, self.dark_mode)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def reset_zoom(self):
         self.lock.acquire(blocking=True)
         task = Task(self.active_tab.reset_zoom)
-        self.active_tab.task_runner.schedule_task(task)
+        self.active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_INPUT)
         self.lock.release()
 
     def new_tab(self, url):
@@ -2471,16 +4815,31 @@ class Browser:
         self.lock.release()
 
     def new_tab_internal(self, url):
-        new_tab = Tab(self, HEIGHT - self.chrome.bottom)
+        if self.process_per_tab:
+            new_tab = TabProcess(self, HEIGHT - self.chrome.bottom)
+        else:
+            new_tab = Tab(self, HEIGHT - self.chrome.bottom)
         self.tabs.append(new_tab)
         self.set_active_tab(new_tab)
         self.schedule_load(url)
 
     def raster_tab(self):
+        viewport = skia.Rect.MakeLTRB(
+            0, self.active_tab_scroll, WIDTH,
+            self.active_tab_scroll + HEIGHT - self.chrome.bottom)
         for composited_layer in self.composited_layers:
-            composited_layer.raster()
+            composited_layer.raster(viewport)
+        self.measure.counter("Surface pool", self.surface_pool.stats())
+        self.measure.counter("Tiles", self.tile_cache.stats())
 
     def raster_chrome(self):
+        cmds = self.chrome.paint()
+        chrome_key = (self.dark_mode,
+            [display_item_key(cmd) for cmd in cmds])
+        if chrome_key == self.chrome_key: return
+        self.chrome_key = chrome_key
+        self.chrome_damaged = True
+
         canvas = self.chrome_surface.getCanvas()
         if self.dark_mode:
             background_color = skia.ColorBLACK
@@ -2488,7 +4847,7 @@ class Browser:
             background_color = skia.ColorWHITE
         canvas.clear(background_color)
 
-        for cmd in self.chrome.paint():
+        for cmd in cmds:
             cmd.execute(canvas)
 
     def update_accessibility(self):
@@ -2558,50 +4917,117 @@ class Browser:
 
     def composite_raster_and_draw(self):
         self.lock.acquire(blocking=True)
+        now = time.time()
+        if now - self.last_tab_check >= TAB_CHECK_INTERVAL_SEC:
+            self.last_tab_check = now
+            self.discard_background_tabs(MAX_LIVE_TABS)
+            self.measure.counter("Tabs", self.tab_stats())
+        self.run_compositor_animations()
         if not self.needs_composite and \
             not self.needs_raster and \
             not self.needs_draw:
             self.lock.release()
             return
-        self.composite()
-        self.raster_chrome()
-        self.raster_tab()
+        if self.needs_composite:
+            self.measure.time('composite')
+            self.composite()
+            self.measure.stop('composite')
+        if self.needs_raster:
+            self.measure.time('raster')
+            self.raster_chrome()
+            self.raster_tab()
+            self.measure.stop('raster')
+        self.measure.time('draw')
         self.paint_draw_list()
         self.draw()
-        self.needs_raster_and_draw = False
+        self.measure.stop('draw')
+        if self.commit_time != None:
+            now = time.perf_counter()
+            self.frame_stats.record_draw(
+                now - self.commit_frame_start, now - self.commit_time)
+            self.commit_time = None
+            self.measure.counter("Frames", self.frame_stats.counters())
+        self.needs_composite = False
+        self.needs_raster = False
+        self.needs_draw = False
         self.lock.release()
 
         if self.needs_accessibility:
             self.update_accessibility()
 
     def schedule_animation_frame(self):
-        def callback():
-            self.lock.acquire(blocking=True)
-            scroll = self.active_tab_scroll
-            active_tab = self.active_tab
-            self.needs_animation_frame = False
-            self.lock.release()
-            task = Task(self.active_tab.run_animation_frame, scroll)
-            active_tab.task_runner.schedule_task(task)
         self.lock.acquire(blocking=True)
-        if self.needs_animation_frame and not self.animation_timer:
-            self.animation_timer = \
-                threading.Timer(REFRESH_RATE_SEC, callback)
-            self.animation_timer.start()
+        if not self.needs_animation_frame:
+            self.lock.release()
+            return
+        if self.frame_in_flight:
+            self.frame_stats.record_dropped()
+            self.lock.release()
+            return
+        scroll = self.active_tab_scroll
+        display_list_version = self.active_tab_display_list_version
+        active_tab = self.active_tab
+        self.needs_animation_frame = False
+        self.frame_in_flight = True
+        self.frame_start = time.perf_counter()
+        self.frame_input_time = self.pending_input_time
+        self.pending_input_time = None
         self.lock.release()
+        task = Task(active_tab.run_animation_frame, scroll,
+            display_list_version)
+        active_tab.task_runner.schedule_task(
+            task, TASK_PRIORITY_RENDERING)
+
+    def note_input(self):
+        if self.pending_input_time == None:
+            self.pending_input_time = time.perf_counter()
+
+    def draw_clip(self):
+        damage = self.draw_damage
+        self.draw_damage = []
+        if damage == None or \
+            self.active_tab_scroll != self.drawn_scroll or \
+            self.dark_mode != self.drawn_dark_mode or \
+            self.hovered_a11y_node:
+            return None
+        clip = skia.Rect.MakeEmpty()
+        for rect in damage:
+            clip.join(rect.makeOffset(
+                0, self.chrome.bottom - self.active_tab_scroll))
+        clip = skia.Rect.Make(clip.makeOutset(
+            INK_OVERFLOW, INK_OVERFLOW).roundOut())
+        if not clip.intersect(skia.Rect.MakeLTRB(
+            0, self.chrome.bottom, WIDTH, HEIGHT)):
+            return skia.Rect.MakeEmpty()
+        return clip
 
     def draw(self):
+        clip = self.draw_clip()
+        chrome_damaged = self.chrome_damaged
+        self.chrome_damaged = False
+        if clip != None and clip.isEmpty() and not chrome_damaged:
+            self.frame_stats.record_skipped_draw()
+            return
+        # The GL back buffer is undefined after a swap, so only the
+        # raster root surface can be redrawn in part.
+        if not self.headless or clip == None:
+            clip = skia.Rect.MakeWH(WIDTH, HEIGHT)
+        self.drawn_scroll = self.active_tab_scroll
+        self.drawn_dark_mode = self.dark_mode
+        self.frame_stats.record_draw_area(
+            int(clip.width() * clip.height()))
+
         canvas = self.root_surface.getCanvas()
+        canvas.save()
+        canvas.clipRect(clip)
         if self.dark_mode:
             canvas.clear(skia.ColorBLACK)
         else:
             canvas.clear(skia.ColorWHITE)
 
-        canvas.save()
         canvas.translate(0,
             self.chrome.bottom - self.active_tab_scroll)
-        for item in self.draw_list:
-            item.execute(canvas)
+        execute_visible(self.draw_list, canvas)
         canvas.restore()
 
         chrome_rect = skia.Rect.MakeLTRB(
@@ -2612,21 +5038,64 @@ class Browser:
         canvas.restore()
 
         self.root_surface.flushAndSubmit()
-        sdl2.SDL_GL_SwapWindow(self.sdl_window)
+        if not self.headless:
+            sdl2.SDL_GL_SwapWindow(self.sdl_window)
+
+    def is_idle(self):
+        tab_idle = self.active_tab.task_runner.is_idle()
+        self.lock.acquire(blocking=True)
+        idle = self.active_tab_display_list != None and \
+            not self.needs_animation_frame and \
+            not self.frame_in_flight and \
+            not self.needs_composite and \
+            not self.needs_raster and \
+            not self.needs_draw and \
+            not self.compositor_animations and \
+            tab_idle
+        self.lock.release()
+        return idle
+
+    def screenshot(self, path=None):
+        image = self.root_surface.makeImageSnapshot()
+        if path:
+            image.save(path, skia.kPNG)
+        return hashlib.sha256(image.tobytes()).hexdigest()
 
     def handle_quit(self):
         self.measure.finish()
         for tab in self.tabs:
             tab.task_runner.set_needs_quit()
-        sdl2.SDL_GL_DeleteContext(self.gl_context)
-        sdl2.SDL_DestroyWindow(self.sdl_window)
+            tab.timers.set_needs_quit()
+        self.fetcher.set_needs_quit()
+        if not self.headless:
+            sdl2.SDL_GL_DeleteContext(self.gl_context)
+            sdl2.SDL_DestroyWindow(self.sdl_window)
+
+HEADLESS_TIMEOUT_SEC = 30
+HEADLESS_POLL_SEC = 0.001
+
+def run_headless(browser, timeout=HEADLESS_TIMEOUT_SEC):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if browser.frame_clock.tick():
+            browser.composite_raster_and_draw()
+            browser.schedule_animation_frame()
+        if browser.is_idle():
+            return True
+        browser.wakeup.wait(
+            min(browser.wait_timeout(), HEADLESS_POLL_SEC))
+        browser.wakeup.clear()
+    return False
 
 def mainloop(browser):
     event = sdl2.SDL_Event()
     ctrl_down = False
     while True:
-        if sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
-            if event.type == sdl2.SDL_QUIT:
+        timeout_ms = math.ceil(browser.wait_timeout() * 1000)
+        if sdl2.SDL_WaitEventTimeout(ctypes.byref(event), timeout_ms) != 0:
+            if event.type == browser.wakeup_event_type:
+                pass
+            elif event.type == sdl2.SDL_QUIT:
                 browser.handle_quit()
                 sdl2.SDL_Quit()
                 sys.exit()
@@ -2675,12 +5144,25 @@ def mainloop(browser):
                     ctrl_down = False
             elif event.type == sdl2.SDL_TEXTINPUT:
                 browser.handle_key(event.text.text.decode('utf8'))
-        browser.composite_raster_and_draw()
-        browser.schedule_animation_frame()
+        if browser.frame_clock.tick():
+            browser.composite_raster_and_draw()
+            browser.schedule_animation_frame()
 
 if __name__ == "__main__":
     import sys
+    args = sys.argv[1:]
+    process_per_tab = "--process-per-tab" in args
+    if process_per_tab: args.remove("--process-per-tab")
+    if args[0] == "--headless":
+        browser = Browser(headless=True, process_per_tab=process_per_tab)
+        browser.new_tab(URL(args[1]))
+        if not run_headless(browser):
+            print("Timed out waiting for the page to render")
+        output = args[2] if len(args) > 2 else None
+        print(browser.screenshot(output))
+        browser.handle_quit()
+        sys.exit()
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
-    browser = Browser()
-    browser.new_tab(URL(sys.argv[1]))
+    browser = Browser(process_per_tab=process_per_tab)
+    browser.new_tab(URL(args[0]))
     mainloop(browser)
\ No newline at end of file
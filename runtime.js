@@ -4,8 +4,21 @@ console = {
   },
 };
 
+PENDING_MUTATIONS = [];
+
+function __flushMutations() {
+  if (PENDING_MUTATIONS.length == 0) return;
+  var mutations = PENDING_MUTATIONS;
+  PENDING_MUTATIONS = [];
+  var removed = call_python("apply_mutations", mutations);
+  for (var i = 0; i < removed.length; i++) {
+    delete LISTENERS[removed[i]];
+  }
+}
+
 document = {
   querySelectorAll: function (s) {
+    __flushMutations();
     var handles = call_python("querySelectorAll", s);
     return handles.map(function (h) {
       return new Node(h);
@@ -18,11 +31,12 @@ function Node(handle) {
 }
 
 Node.prototype.getAttribute = function (attr) {
+  __flushMutations();
   return call_python("getAttribute", this.handle, attr);
 };
 
 Node.prototype.setAttribute = function (attr, value) {
-  return call_python("setAttribute", this.handle, attr, value);
+  PENDING_MUTATIONS.push(["setAttribute", this.handle, attr, value]);
 };
 
 LISTENERS = {};
@@ -44,6 +58,14 @@ Node.prototype.addEventListener = function (type, listener) {
   list.push(listener);
 };
 
+function __dispatchEvent(handle, type) {
+  try {
+    return new Node(handle).dispatchEvent(new Event(type));
+  } finally {
+    __flushMutations();
+  }
+}
+
 Node.prototype.dispatchEvent = function (evt) {
   var type = evt.type;
   var handle = this.handle;
@@ -56,34 +78,56 @@ Node.prototype.dispatchEvent = function (evt) {
 
 Object.defineProperty(Node.prototype, "innerHTML", {
   set: function (s) {
-    call_python("innerHTML_set", this.handle, s.toString());
+    PENDING_MUTATIONS.push(["innerHTML", this.handle, s.toString()]);
   },
 });
 
 Object.defineProperty(Node.prototype, "style", {
   set: function (s) {
-    call_python("style_set", this.handle, s.toString());
+    PENDING_MUTATIONS.push(["style", this.handle, s.toString()]);
   },
 });
 
 SET_TIMEOUT_REQUESTS = {};
+NEXT_TIMER_HANDLE = 0;
 
 function setTimeout(callback, time_delta) {
-  var handle = Object.keys(SET_TIMEOUT_REQUESTS).length;
+  var handle = NEXT_TIMER_HANDLE++;
   SET_TIMEOUT_REQUESTS[handle] = callback;
   call_python("setTimeout", handle, time_delta);
+  return handle;
+}
+
+function setInterval(callback, time_delta) {
+  var handle = NEXT_TIMER_HANDLE++;
+  SET_TIMEOUT_REQUESTS[handle] = callback;
+  call_python("setInterval", handle, time_delta);
+  return handle;
 }
 
-function __runSetTimeout(handle) {
+function clearTimeout(handle) {
+  delete SET_TIMEOUT_REQUESTS[handle];
+  call_python("clearTimeout", handle);
+}
+
+clearInterval = clearTimeout;
+
+function __runSetTimeout(handle, repeat) {
   var callback = SET_TIMEOUT_REQUESTS[handle];
-  callback();
+  if (!callback) return;
+  if (!repeat) delete SET_TIMEOUT_REQUESTS[handle];
+  try {
+    callback();
+  } finally {
+    __flushMutations();
+  }
 }
 
 XHR_REQUESTS = {};
+NEXT_XHR_HANDLE = 0;
 
 function XMLHttpRequest() {
-  this.handle = Object.keys(XHR_REQUESTS).length;
-  XHR_REQUESTS[this.handle] = this;
+  this.handle = NEXT_XHR_HANDLE++;
 }
 
 XMLHttpRequest.prototype.open = function (method, url, is_async) {
@@ -93,14 +137,38 @@ XMLHttpRequest.prototype.open = function (method, url, is_async) {
 };
 
 XMLHttpRequest.prototype.send = function (body) {
-  this.responseText = call_python("XMLHttpRequest_send", this.method, this.url, body, this.is_async, this.handle);
+  XHR_REQUESTS[this.handle] = this;
+  try {
+    this.responseText = call_python("XMLHttpRequest_send", this.method, this.url, body, this.is_async, this.handle);
+  } catch (e) {
+    delete XHR_REQUESTS[this.handle];
+    throw e;
+  }
 };
 
 function __runXHROnload(body, handle) {
   var obj = XHR_REQUESTS[handle];
+  if (!obj) return;
+  delete XHR_REQUESTS[handle];
   var evt = new Event("load");
   obj.responseText = body;
-  if (obj.onload) obj.onload(evt);
+  try {
+    if (obj.onload) obj.onload(evt);
+  } finally {
+    __flushMutations();
+  }
+}
+
+function __runXHROnerror(handle) {
+  var obj = XHR_REQUESTS[handle];
+  if (!obj) return;
+  delete XHR_REQUESTS[handle];
+  var evt = new Event("error");
+  try {
+    if (obj.onerror) obj.onerror(evt);
+  } finally {
+    __flushMutations();
+  }
 }
 
 RAF_LISTENERS = [];
@@ -113,7 +181,47 @@ function requestAnimationFrame(fn) {
 function __runRAFHandlers() {
   var handlers_copy = RAF_LISTENERS;
   RAF_LISTENERS = [];
-  for (var i = 0; i < handlers_copy.length; i++) {
-    handlers_copy[i]();
+  try {
+    for (var i = 0; i < handlers_copy.length; i++) {
+      handlers_copy[i]();
+    }
+  } finally {
+    __flushMutations();
+  }
+}
+
+IDLE_CALLBACKS = {};
+NEXT_IDLE_HANDLE = 0;
+
+function IdleDeadline(deadline, did_timeout) {
+  this.deadline = deadline;
+  this.didTimeout = did_timeout;
+}
+
+IdleDeadline.prototype.timeRemaining = function () {
+  return Math.max(0, this.deadline - Date.now());
+};
+
+function requestIdleCallback(callback, options) {
+  var handle = NEXT_IDLE_HANDLE++;
+  IDLE_CALLBACKS[handle] = callback;
+  var timeout = (options && options.timeout) || 0;
+  call_python("requestIdleCallback", handle, timeout);
+  return handle;
+}
+
+function cancelIdleCallback(handle) {
+  delete IDLE_CALLBACKS[handle];
+  call_python("cancelIdleCallback", handle);
+}
+
+function __runIdleCallback(handle, deadline, did_timeout) {
+  var callback = IDLE_CALLBACKS[handle];
+  if (!callback) return;
+  delete IDLE_CALLBACKS[handle];
+  try {
+    callback(new IdleDeadline(deadline, did_timeout));
+  } finally {
+    __flushMutations();
   }
 }